@@ -4,6 +4,7 @@ from .Fusion360Utilities.Fusion360Utilities import AppObjects
 from .InfoCommand import InfoCommand
 from .ShowLogsCommand import ShowLogsCommand
 from .SliceCommand import SliceCommand
+from .enginelog import stop_logging
 
 commands = []
 
@@ -80,3 +81,4 @@ def run(context):
 def stop(context):
     for stop_command in commands:
         stop_command.on_stop()
+    stop_logging()
@@ -1,6 +1,7 @@
 from adsk.core import Command, CommandInputs
 from .Fusion360Utilities.Fusion360CommandBase import Fusion360CommandBase
 from .curaengine import engine_log_file
+from .enginelog import clear_logs
 
 
 class ShowLogsCommand(Fusion360CommandBase):
@@ -8,7 +9,7 @@ class ShowLogsCommand(Fusion360CommandBase):
     def on_input_changed(self, command: Command, inputs: CommandInputs, changed_input, input_values):
         if changed_input == self.delete_button:
             self.text_box.text = ''
-            open(engine_log_file, 'w').close()
+            clear_logs()
 
     def on_create(self, command: Command, inputs: CommandInputs):
         content = ''
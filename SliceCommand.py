@@ -8,10 +8,10 @@ import shutil
 import tempfile
 import threading
 import traceback
-from collections import defaultdict
+from concurrent.futures import Future, wait
 from copy import deepcopy
 from string import Formatter
-from time import time
+from time import time, perf_counter
 from uuid import uuid4
 
 from adsk.core import Command, Vector3D, CommandInputs, DialogResults, CustomEventArgs, CustomEventHandler, \
@@ -19,12 +19,20 @@ from adsk.core import Command, Vector3D, CommandInputs, DialogResults, CustomEve
 from adsk.fusion import BRepBody, CustomGraphicsCoordinates, TemporaryBRepManager
 from .Fusion360Utilities.Fusion360CommandBase import Fusion360CommandBase
 from .Fusion360Utilities.Fusion360Utilities import AppObjects
-from .curaengine import run_engine, parse_segment, TIME_KEYS
+from .curaengine import TIME_KEYS
+from .enginecapture import capture_path
+from .enginelog import EngineLog
+from .enginemetrics import EngineMetrics, MetricsServer
+from .enginepool import EnginePool
+from .layerdecoding import make_layer_decoder
+from .layerstore import make_layer_spill
 from .messages import Slice, dict_to_setting_list, ObjectList, Object, LineType, Extruder
 from .settings import setting_types, collect_changed_setting_if_different_from_parent, \
     setting_tree_to_dict_and_default, useless_settings, \
     save_visibility, read_visibility, read_machine_settings, read_configuration, fdmprinterfile, \
     read_extruder_config, get_config, stacked_mapping, computed_dict
+from .slicing import MessagePipeline, SliceResult, StallWatchdog
+from .toolpath import preview_level
 from .util import event, recursive_inputs, display_machine, create_visibility_checkboxes
 
 # https://gist.github.com/mRB0/740c25fdae3dc0b0ee7a
@@ -34,85 +42,148 @@ ao = AppObjects()
 
 engine_event_id = 'ENGINE_CUSTOM_EVENT'
 
+# the fields actually used from each received message, the others are skipped without being decoded
+decoded_fields = {
+    'cura.proto.Progress': ('amount',),
+    'cura.proto.PrintTimeMaterialEstimates': (
+        'time_none', 'time_inset_0', 'time_inset_x', 'time_skin', 'time_support', 'time_skirt', 'time_infill',
+        'time_support_infill', 'time_travel', 'time_retract', 'time_support_interface'),
+    'cura.proto.GCodePrefix': ('data',),
+    'cura.proto.GCodeLayer': ('data',),
+    'cura.proto.LayerOptimized': ('id', 'height', 'thickness', 'path_segment.extruder', 'path_segment.points',
+                                  'path_segment.point_type', 'path_segment.line_type'),
+}
+
 
 class CancelException(Exception):
     pass
 
 
-def run_engine_in_other_thread(message, endpoint):
+def run_engine_in_other_thread(engine_pool, layer_decoder, metrics, message, endpoint):
     def fire_if_not_canceled(info):
         handle_cancel()
         AppObjects().app.fireCustomEvent(engine_event_id, info)
 
     def handle_cancel():
-        if endpoint.get('canceled'):
+        if endpoint.canceled:
             raise CancelException
 
-    def child_started(process):
-        endpoint['child_process'] = process
+    def on_layer_decoded(future, added):
+        # the only place where a decoded layer is added, added is resolved after it, the first layer that failed to
+        # decode is reported like an exception of the engine thread
+        try:
+            error = future.exception()
+            if error is None:
+                shared = future.result()
+                if endpoint.canceled:
+                    shared.release()
+                else:
+                    endpoint.layers.add(shared.layer, shared.release)
+                    AppObjects().app.fireCustomEvent(engine_event_id, 'layer|' + str(shared.layer.id))
+            elif endpoint.fail(''.join(traceback.format_exception(type(error), error, error.__traceback__))):
+                job_log().info('layer decoding failed %s', endpoint.exception)
+                if not endpoint.canceled:
+                    AppObjects().app.fireCustomEvent(engine_event_id, 'exception')
+        finally:
+            added.set_result(None)
+
+    def job_log():
+        # the log of the engine running the job, so that these lines land in its section
+        return endpoint.engine.log if endpoint.engine else EngineLog()
+
+    def on_stall(reason):
+        job_log().info('stalled: %s', reason)
+        endpoint.stall(reason)
+        if not endpoint.canceled:
+            AppObjects().app.fireCustomEvent(engine_event_id, 'stalled')
+
+    def on_frame(raw_received, received_type):
+        watchdog.frame(received_type)
+        pipeline.put(raw_received, received_type)
+
+    def on_keep_alive():
+        watchdog.frame(None)
+        handle_cancel()
+
+    decoding_layers = []
+    config = read_configuration()
+    watchdog = StallWatchdog(on_stall, float(config.get('engine_stall_timeout', 120)),
+                             float(config.get('engine_progress_timeout', 600)))
 
     previous_time = int(time() / 2)
     prefix = None
     with tempfile.TemporaryFile() as gcode_collector:
         def on_message(raw_received, received_type):
             nonlocal previous_time, prefix
+            fields = decoded_fields.get(received_type.symbol)
+
+            def decode(lazy=False):
+                start = perf_counter()
+                decoded = (received_type.lazy_loads if lazy else received_type.loads)(raw_received, fields)
+                metrics.decoded(received_type, perf_counter() - start)
+                return decoded
+
             new_time = int(time() / 5)
             if previous_time != new_time:
                 fire_if_not_canceled(received_type.symbol)
                 previous_time = new_time
             handle_cancel()
             if received_type.symbol == 'cura.proto.Progress':
-                print('Progress' + str(received_type.loads(raw_received).amount))
+                amount = decode().amount
+                watchdog.progress(amount)
+                print('Progress' + str(amount))
             else:
                 print(received_type.symbol)
             if received_type.symbol == 'cura.proto.PrintTimeMaterialEstimates':
-                endpoint['estimates'] = received_type.loads(raw_received)
+                endpoint.estimates = decode()
                 complete_gcode = tempfile.NamedTemporaryFile()
                 complete_gcode.write(prefix)
                 gcode_collector.seek(0)
                 shutil.copyfileobj(gcode_collector, complete_gcode)
-                endpoint['gcode_file'] = complete_gcode
+                endpoint.gcode_file = complete_gcode
                 complete_gcode.seek(0)
             if received_type.symbol == 'cura.proto.GCodePrefix':
-                prefix = received_type.loads(raw_received).data
+                prefix = decode().data
             if received_type.symbol == 'cura.proto.GCodeLayer':
-                data = received_type.loads(raw_received).data
+                data = decode().data
                 gcode_collector.write(data)
             if received_type.symbol == 'cura.proto.SlicingFinished':
-                endpoint['done'] = True
+                wait(decoding_layers)  # the callbacks may not have run yet
+                endpoint.finish()
                 fire_if_not_canceled('done')
-            if received_type.symbol == 'cura.proto.LayerOptimized':
-                line_strips_per_type = defaultdict(list)
-                layer = received_type.loads(raw_received)
-                for segment in layer.path_segment:
-                    coord_iterator = iter(parse_segment(segment, layer.height))
-                    current_list = []
-                    current_type = None
-                    for type, point_x in zip(segment.line_type, coord_iterator):
-                        point = point_x / 10, next(coord_iterator) / 10, next(coord_iterator) / 10
-                        if len(current_list):
-                            current_list.extend(point)
-                        if type != current_type:
-                            current_list = []
-                            current_list.extend(point)
-                            current_type = type
-                            line_strips_per_type[current_type].append(current_list)
-                endpoint['layers'][layer.id] = {'height': layer.height, 'thickness': layer.thickness, 'by_type': {}}
-                for type, strips in line_strips_per_type.items():
-                    endpoint['layers'][layer.id]['by_type'][type] = {
-                        'strip_lengths': [len(strip) // 3 for strip in strips],
-                        'giant_strip': [coord for strip in strips for coord in strip]
-                    }
+            if received_type.symbol == 'cura.proto.LayerOptimized' and layer_decoder:
+                added = Future()
+                layer_decoder.submit(raw_received, fields).add_done_callback(lambda future: on_layer_decoded(future, added))
+                decoding_layers.append(added)
+            elif received_type.symbol == 'cura.proto.LayerOptimized':
+                # the path segments are only decoded when the layer is first previewed, see LayerStore.layer()
+                layer = decode(lazy=True)
+                endpoint.layers.add_message(layer)
                 fire_if_not_canceled('layer|' + str(layer.id))
 
+        def on_timed_message(raw_received, received_type):
+            start = perf_counter()
+            try:
+                on_message(raw_received, received_type)
+            finally:
+                metrics.handled(received_type, perf_counter() - start)
+
         try:
-            run_engine(message, on_message, child_started, handle_cancel)
+            with MessagePipeline(on_timed_message) as pipeline, watchdog:
+                engine_pool.run(message, on_frame, endpoint.started, on_keep_alive, capture_path(config), metrics)
+            log = job_log()
+            log.info('message queue %s', pipeline.metrics())
+            log.info('watchdog %s', watchdog.stats())
+            metrics.dump()
         except CancelException:
             print('CANCEL')
             return
         except:
+            if endpoint.canceled:
+                print('CANCEL')  # the engine was killed in the middle of something
+                return
             fire_if_not_canceled('exception')
-            endpoint['exception'] = traceback.format_exc()
+            endpoint.exception = traceback.format_exc()
             print('exception', traceback.format_exc())
             traceback.print_exc()
 
@@ -162,16 +233,12 @@ class GCodeFormatter(Formatter):
         self.prepend_dict['material_bed_temp_prepend'] = not (bed_temp_set & used_args)
 
 
-def compute_layer_type_preview(layer, layer_id, type, precomputed_layers):
+def compute_layer_type_preview(layer, type, level, precomputed_layers):
     manager = TemporaryBRepManager.get()
-    data = layer['by_type'][type]
-    if type not in precomputed_layers[layer_id]:
-        index = 0
+    if (type, level) not in precomputed_layers[layer.id]:
         bodies = []
         lines = []
-        for strip_len in data['strip_lengths']:
-            current_poly = data['giant_strip'][index * 3:(index + strip_len) * 3]
-            index += strip_len
+        for _, _, current_poly in layer.strips((type,), level):
             iterator = iter(current_poly)
             points = [Point3D.create(x, next(iterator), next(iterator)) for x in iterator]
             previous_point = None
@@ -181,7 +248,7 @@ def compute_layer_type_preview(layer, layer_id, type, precomputed_layers):
                 previous_point = point
         if len(lines):
             bodies.append(manager.createWireFromCurves(lines, True)[0])
-        precomputed_layers[layer_id][type] = bodies
+        precomputed_layers[layer.id][type, level] = bodies
 
 
 def list_of_str_to_filename(str_list):
@@ -198,10 +265,8 @@ class SliceCommand(Fusion360CommandBase):
 
     def cancel_engine(self):
         if self.engine_endpoint:
-            self.engine_endpoint['canceled'] = True
-            if 'child_process' in self.engine_endpoint:
-                self.engine_endpoint['child_process'].terminate()
-            self.engine_event.remove(self.engine_endpoint['handler'])
+            self.engine_endpoint.cancel()
+            self.engine_event.remove(self.engine_endpoint.handler)
 
     def on_preview(self, command: Command, inputs: CommandInputs, args, input_values):
         max_x = self.stacked_dict['machine_width'] / 10
@@ -221,10 +286,11 @@ class SliceCommand(Fusion360CommandBase):
         bodies = input_values['selection']
         slider = self.layer_slider
         if settings == self.running_settings and self.running_models == bodies:
-            if self.engine_endpoint and self.engine_endpoint['done']:
-                layer_keys = self.engine_endpoint['layers'].keys()
-                slider.minimumValue = min(layer_keys)
-                slider.maximumValue = max(layer_keys)
+            if self.engine_endpoint and self.engine_endpoint.done:
+                layer_keys = self.engine_endpoint.layers.ids()
+                if layer_keys:
+                    slider.minimumValue = min(layer_keys)
+                    slider.maximumValue = max(layer_keys)
                 linework_group = self.graphics.addGroup()
                 if not center_is_zero:
                     transform = linework_group.transform
@@ -232,25 +298,26 @@ class SliceCommand(Fusion360CommandBase):
                     linework_group.transform = transform
                 for body in bodies:
                     body.isVisible = False
-                for mesh in self.engine_endpoint['mesh']:
+                for mesh in self.engine_endpoint.mesh:
                     self.graphics.addMesh(CustomGraphicsCoordinates.create(mesh.nodeCoordinatesAsDouble),
                                           mesh.nodeIndices, [], []).setOpacity(0.2, True)
-                cached_layers = self.engine_endpoint['precomputed_layers']
-                layer_range = set(range(slider.valueOne, slider.valueTwo))
+                cached_layers = self.engine_endpoint.precomputed_layers
                 line_types = {v.value for v in LineType if
                               v in self.layer_type_inputs and self.layer_type_inputs[v].value}
-                for id in layer_range.intersection(self.engine_endpoint['layers'].keys()):
-                    cached_layer = cached_layers[id]
-                    original_layer = self.engine_endpoint['layers'][id]
-                    for type in line_types.intersection(original_layer['by_type'].keys()):
-                        compute_layer_type_preview(original_layer, id, type, cached_layers)
-                        for body in cached_layer[type]:
+                layers = list(self.engine_endpoint.layers.query(slider.valueOne, slider.valueTwo, line_types))
+                # the detail goes down when more layers are shown, to draw about preview_segments lines at most
+                level = preview_level(layers, line_types, self.preview_segments)
+                for layer in layers:
+                    cached_layer = cached_layers[layer.id]
+                    for type in line_types.intersection(layer.line_types()):
+                        compute_layer_type_preview(layer, type, level, cached_layers)
+                        for body in cached_layer[type, level]:
                             new_line = linework_group.addBRepBody(body)
                             new_line.depthPriority = 2
 
                 AppObjects().app.activeViewport.refresh()
                 self.info_box.text = 'preview visible'
-                estimates = self.engine_endpoint['estimates']
+                estimates = self.engine_endpoint.estimates
                 time_elements = list([(k, estimates[k]) for k in TIME_KEYS if k in estimates])
                 total_time = sum([v for k, v in time_elements])
                 time_elements = [('total_time', total_time)] + time_elements
@@ -272,7 +339,7 @@ class SliceCommand(Fusion360CommandBase):
                                   [])
 
         def on_engine(args: CustomEventArgs):
-            layer_keys = self.engine_endpoint['layers'].keys()
+            layer_keys = self.engine_endpoint.layers.ids()
             if len(layer_keys):
                 slider.minimumValue = min(layer_keys)
                 slider.maximumValue = max(layer_keys)
@@ -280,22 +347,45 @@ class SliceCommand(Fusion360CommandBase):
                 self.cancel_engine()
                 command.doExecutePreview()
             if args.additionalInfo == 'exception':
-                AppObjects().ui.messageBox(repr(endpoint['exception']))
+                AppObjects().ui.messageBox(repr(endpoint.exception))
+            if args.additionalInfo == 'stalled' and endpoint is self.engine_endpoint:
+                if endpoint.stall_retries > 0:
+                    self.info_box.text = 'engine stalled (%s), retrying ...' % endpoint.stalled
+                    self.retrying_stalled = endpoint.stall_retries - 1
+                    self.running_settings = None
+                    command.doExecutePreview()
+                else:
+                    self.info_box.text = 'engine stalled: %s' % endpoint.stalled
 
         handler = event(CustomEventHandler, on_engine)
-        endpoint = dict(handler=handler, canceled=False, done=False, estimates={}, layers={}, gcode_file=None,
-                        exception=None, mesh=meshes, precomputed_layers=defaultdict(dict))
+        configuration = read_configuration()
+        endpoint = SliceResult(handler, meshes, make_layer_spill(configuration))
+        if self.retrying_stalled is None:
+            endpoint.stall_retries = int(configuration.get('engine_stall_retries', 1))
+        else:
+            endpoint.stall_retries = self.retrying_stalled
+            self.retrying_stalled = None
         self.cancel_engine()
+        if self.engine_endpoint:
+            self.engine_endpoint.close()
         self.engine_event.add(handler)
         self.engine_endpoint = endpoint
         self.info_box.text = 'computing preview ...'
         self.time_box.text = 'computing preview ...'
-        threading.Thread(target=run_engine_in_other_thread, args=[slice_msg, endpoint]).start()
+        threading.Thread(target=run_engine_in_other_thread,
+                         args=[self.engine_pool, self.layer_decoder, self.engine_metrics, slice_msg, endpoint]).start()
 
     def on_destroy(self, command: Command, inputs: CommandInputs, reason, input_values):
         AppObjects().app.unregisterCustomEvent(engine_event_id)
         try:
             self.cancel_engine()
+            self.engine_pool.close()
+            if self.layer_decoder:
+                self.layer_decoder.shutdown()
+            if self.metrics_server:
+                self.metrics_server.close()
+            if self.engine_endpoint:
+                self.engine_endpoint.close()
             save_visibility(self.visibilities)
         except AttributeError:
             pass
@@ -369,9 +459,9 @@ class SliceCommand(Fusion360CommandBase):
                 attr.deleteMe()
         for entity in input_values['selection']:
             entity.attributes.add('FusedCura', 'selected_for_printing', 'True')
-        if self.gcode_file is not None and self.engine_endpoint and self.engine_endpoint['done']:
+        if self.gcode_file is not None and self.engine_endpoint and self.engine_endpoint.done:
             with open(self.gcode_file, 'wb') as out:
-                shutil.copyfileobj(self.engine_endpoint['gcode_file'], out)
+                shutil.copyfileobj(self.engine_endpoint.gcode_file, out)
 
     def on_create(self, command: Command, inputs: CommandInputs):
         command.isExecutedWhenPreEmpted = False
@@ -382,10 +472,18 @@ class SliceCommand(Fusion360CommandBase):
             AppObjects().app.unregisterCustomEvent(engine_event_id)
             self.engine_event = AppObjects().app.registerCustomEvent(engine_event_id)
         self.engine_endpoint = None
+        self.retrying_stalled = None  # the retries left when restarting a stalled session
         configuration = read_configuration()
         if not configuration:
             AppObjects().ui.commandDefinitions.itemById('ConfigureFusedCuraCmd').execute()
             return
+        self.engine_pool = EnginePool()
+        self.engine_pool.start()
+        self.layer_decoder = make_layer_decoder(configuration)
+        self.engine_metrics = EngineMetrics()
+        metrics_port = int(configuration.get('metrics_port', 0) or 0)
+        self.metrics_server = MetricsServer(self.engine_metrics, metrics_port) if metrics_port else None
+        self.preview_segments = int(configuration.get('preview_segments', 100000) or 100000)
         self.changed_settings = {}
         self.running_settings = {}
         self.running_models = None
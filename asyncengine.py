@@ -0,0 +1,137 @@
+import asyncio
+import socket
+from contextlib import ExitStack
+
+from .curaengine import FrameParser, connect_timeout, engine_arguments, engine_listener, engine_process_params, \
+    slice_header
+from .enginelog import EngineLog
+from .messages import Slice
+from .settings import read_configuration
+
+
+class AsyncEngine:
+    # Runs a slice in a CuraEngine process from an asyncio event loop, several can run concurrently on the same loop:
+    #     async with AsyncEngine(slice_message, timeout=30) as engine:
+    #         async for type_def, payload in engine.messages():
+    #             ...
+    # Cancelling the task, a timeout (asyncio.TimeoutError) or leaving the block kill the engine process right away.
+    PUMP_TIMEOUT = 1  # longest wait in seconds for the end of the engine output once it exited
+
+    def __init__(self, slice_message: Slice, timeout=None):
+        self.slice_message = slice_message
+        self.timeout = timeout  # longest wait in seconds for the engine to connect and between two received chunks
+        self.process = None
+        self.closed = False  # the engine sent _CLOSE_SOCKET
+        self._server = None
+        self._reader = None
+        self._writer = None
+        self._pump = None
+        self.log = EngineLog()
+        self._listener = ExitStack()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def start(self):
+        self.log.start_job()
+        try:
+            config = read_configuration()
+            self.log.info('configuration %s', dict(config))
+            try:
+                self._reader, self._writer = await self._launch(config)
+            except (asyncio.TimeoutError, ChildProcessError) as error:
+                if self._server.sockets[0].family != getattr(socket, 'AF_UNIX', None):
+                    raise
+                # the stock CuraEngine can't connect to a Unix domain socket, see curaengine.engine_listener()
+                self.log.info('no connection on the Unix domain socket (%r), launching the engine again on TCP', error)
+                await self._stop()
+                self._reader, self._writer = await self._launch(dict(config, engine_transport='tcp'))
+            encoded_chunks = Slice.dump_chunks(self.slice_message)
+            self._writer.writelines([slice_header(encoded_chunks)] + encoded_chunks)
+            await asyncio.wait_for(self._writer.drain(), self.timeout)
+        except BaseException:
+            await self.close()
+            raise
+
+    async def _launch(self, config):
+        # starts the engine on a new listener and returns its connection, raises asyncio.TimeoutError when it didn't
+        # connect in time and ChildProcessError when it exited first
+        loop = asyncio.get_running_loop()
+        connection = loop.create_future()
+
+        def on_connection(reader, writer):
+            if connection.done():
+                writer.close()
+            else:
+                connection.set_result((reader, writer))
+
+        server_socket, address = self._listener.enter_context(engine_listener(config))
+        server_socket.setblocking(False)
+        if server_socket.family == getattr(socket, 'AF_UNIX', None):
+            self._server = await asyncio.start_unix_server(on_connection, sock=server_socket)
+        else:
+            self._server = await asyncio.start_server(on_connection, sock=server_socket)
+        arguments = engine_arguments(config, address)
+        self.log.info('%s', arguments)
+        self.process = await asyncio.create_subprocess_exec(*arguments, stdout=asyncio.subprocess.PIPE,
+                                                            stderr=asyncio.subprocess.STDOUT,
+                                                            **engine_process_params())
+        self._pump = loop.create_task(self.log.pump_async(self.process.stdout))
+        exited = loop.create_task(self.process.wait())
+        try:
+            await asyncio.wait([connection, exited], timeout=connect_timeout(server_socket, self.timeout),
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            exited.cancel()
+        if connection.done():
+            return connection.result()
+        connection.cancel()
+        if self.process.returncode is not None:
+            raise ChildProcessError('CuraEngine exited with %s before connecting' % self.process.returncode)
+        raise asyncio.TimeoutError()
+
+    async def messages(self):
+        # yields the (type_def, payload) frames sent by the engine until it closes the connection
+        parser = FrameParser()
+        while not parser.done:
+            data = await asyncio.wait_for(self._reader.read(FrameParser.READ_SIZE), self.timeout)
+            if not data:
+                break
+            for type_def, payload in parser.feed(data):
+                if type_def is not None:
+                    yield type_def, payload
+        self.closed = parser.closed
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+        try:
+            await self._stop()
+        finally:
+            self._reader = self._writer = None
+
+    async def _stop(self):
+        # kills the engine and closes its listener
+        if self._server:
+            self._server.close()
+        try:
+            if self.process and self.process.returncode is None:
+                try:
+                    self.process.kill()
+                except ProcessLookupError:
+                    pass  # exited in the meantime
+                self.log.info('engine exited %s', await self.process.wait())
+        finally:
+            self._listener.close()
+            self._server = None
+            pump, self._pump = self._pump, None
+            if pump:
+                # a child of the engine may still hold its output open
+                try:
+                    await asyncio.wait([pump], timeout=self.PUMP_TIMEOUT)
+                finally:
+                    pump.cancel()
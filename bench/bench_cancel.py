@@ -0,0 +1,108 @@
+'''
+Times cancelling a running engine: from EngineHandle.terminate() to
+run_engine returning, with a stand-in engine that hangs before connecting
+and one that hangs after receiving the Slice. Then the same through
+EnginePool.run, the first one cancelling an EngineWorker while it starts.
+Fails when a cancel takes longer than the bound or leaves the engine
+process alive.
+
+usage: python bench/bench_cancel.py [repeat] [bound_seconds]
+'''
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from common import load_package, import_from, make_slice
+
+# stand-in engines, run by a shell like CuraEngine, with a child process to check the whole group is killed
+HUNG_BEFORE_CONNECT = 'import subprocess, sys, time; subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"]); time.sleep(60)'
+HUNG_AFTER_SLICE = '''
+import socket, subprocess, sys, time
+subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+host, port = sys.argv[1].rsplit(":", 1)
+engine_socket = socket.create_connection((host, int(port)))
+while engine_socket.recv(65536):
+    pass
+'''
+
+
+def launcher(curaengine, script, started):
+    def launch(config, address, log):
+        process = subprocess.Popen('"%s" -c \'%s\' "%s"' % (sys.executable, script, address), shell=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   **curaengine.engine_process_params())
+        log.pump(process.stdout)
+        started.set()
+        return process
+
+    return launch
+
+
+def group_alive(pgid, timeout=1.0):
+    # the killed processes are reparented and reaped asynchronously, zombies count as dead
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        processes = subprocess.run(['ps', '-A', '-o', 'pgid=,stat='], stdout=subprocess.PIPE, text=True).stdout
+        if not any(int(group) == pgid and not stat.startswith('Z')
+                   for group, stat in (line.split() for line in processes.splitlines())):
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def engine_runner(curaengine, slice_msg, script, started, handles):
+    return threading.Thread(target=curaengine.run_engine, args=(slice_msg, lambda payload, type_def: None),
+                            kwargs={'child_started_handler': handles.append, 'config': {},
+                                    'launcher': launcher(curaengine, script, started)})
+
+
+def pool_runner(curaengine, enginepool, slice_msg, script, started, handles):
+    # without idle engines, each job cold starts its EngineWorker
+    pool = enginepool.EnginePool(size=0, config={'curaengine': 'stand-in'},
+                                 launcher=launcher(curaengine, script, started))
+    return threading.Thread(target=pool.run, args=(slice_msg, lambda payload, type_def: None, handles.append))
+
+
+def cancel_once(runner, script, delay):
+    started = threading.Event()
+    handles = []
+    thread = runner(script, started, handles)
+    thread.start()
+    started.wait()
+    time.sleep(delay)  # lets the stand-in connect and receive the Slice
+    start = time.perf_counter()
+    handles[0].terminate()
+    thread.join()
+    seconds = time.perf_counter() - start
+    return seconds, os.name != 'nt' and group_alive(handles[0].process.pid)
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    bound = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    load_package()
+    messages = import_from('FusedCura', 'messages')
+    curaengine = import_from('FusedCura', 'curaengine')
+    enginepool = import_from('FusedCura', 'enginepool')
+    slice_msg = make_slice(messages, vertex_count=100000)
+    runners = [('', lambda *args: engine_runner(curaengine, slice_msg, *args)),
+               ('pool, ', lambda *args: pool_runner(curaengine, enginepool, slice_msg, *args))]
+    failed = False
+    for (prefix, runner), (name, script, delay) in [(runner, case) for runner in runners for case in [
+            ('hung before connect', HUNG_BEFORE_CONNECT, 0.2), ('hung after the Slice', HUNG_AFTER_SLICE, 1.0)]]:
+        name = prefix + name
+        results = [cancel_once(runner, script, delay) for _ in range(repeat)]
+        seconds = [result[0] for result in results]
+        survivors = sum(result[1] for result in results)
+        print('%-28s median %7.1f ms   max %7.1f ms   surviving process groups: %d' % (
+            name, statistics.median(seconds) * 1000, max(seconds) * 1000, survivors))
+        failed |= max(seconds) > bound or survivors > 0
+    if failed:
+        sys.exit('cancel took longer than %.1f s or left the engine running' % bound)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+'''
+Times Slice encoding and LayerOptimized decoding.
+
+usage: python bench/bench_codec.py [other_checkout]
+
+When another checkout is given (e.g. a `git worktree` of an older revision),
+both are timed on the same payloads and the speedup is printed.
+'''
+import sys
+
+from common import REPO, load_package, import_from, make_slice, make_layer, best_of
+
+
+def measure(name, path):
+    load_package(path, name)
+    messages = import_from(name, 'messages')
+    slice_msg = make_slice(messages)
+    raw_layer = make_layer(messages).dumps()
+    return {
+        'Slice encode': best_of(lambda: messages.Slice.dumps(slice_msg)),
+        'LayerOptimized decode': best_of(lambda: messages.LayerOptimized.loads(raw_layer)),
+    }
+
+
+def main():
+    current = measure('FusedCura', REPO)
+    other = measure('FusedCuraOther', sys.argv[1]) if len(sys.argv) > 1 else None
+    for key, seconds in current.items():
+        line = '%-24s %8.2f ms' % (key, seconds * 1000)
+        if other:
+            line += '   other: %8.2f ms   speedup: %.2fx' % (other[key] * 1000, other[key] / seconds)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''
+Runs layerdecoding.LayerDecoder on synthetic 2D and 3D layers and checks
+that the ToolpathLayers it returns in shared memory are the ones of
+toolpath.toolpath_layer in this process. Then times the decoding of all
+the layers in the worker processes against toolpath_layer here. The
+checkout is loaded under a package name that differs from its directory,
+like in Fusion 360, so the workers have to find it without sys.path.
+
+usage: python bench/bench_decoder.py [--layers N] [--processes N]
+'''
+import argparse
+import sys
+import time
+
+from common import load_package, import_from, make_layer
+
+# the fields decoded by SliceCommand
+FIELDS = ('id', 'height', 'thickness', 'path_segment.extruder', 'path_segment.points', 'path_segment.point_type',
+          'path_segment.line_type')
+
+
+def same_layer(layer, expected):
+    return (layer.id, layer.height, layer.thickness) == (expected.id, expected.height, expected.thickness) and all(
+        buffer.tolist() == expected_buffer.tolist()
+        for buffer, expected_buffer in zip(layer.buffers(), expected.buffers()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layers', type=int, default=40)
+    parser.add_argument('--processes', type=int, default=2)
+    args = parser.parse_args()
+    load_package()
+    messages = import_from('FusedCura', 'messages')
+    toolpath = import_from('FusedCura', 'toolpath')
+    layerdecoding = import_from('FusedCura', 'layerdecoding')
+    if layerdecoding.shared_memory is None:
+        sys.exit('LayerDecoder needs multiprocessing.shared_memory')
+    payloads = [messages.LayerOptimized.dumps(make_layer(messages, layer_id=index, segment_count=500,
+                                                         point_type=index % 2, seed=index))
+                for index in range(args.layers)]
+    decoder = layerdecoding.LayerDecoder(args.processes)
+    try:
+        decoder.submit(payloads[0], FIELDS).result()  # starts the workers
+        start = time.perf_counter()
+        shared_layers = [future.result() for future in [decoder.submit(payload, FIELDS) for payload in payloads]]
+        decoded = time.perf_counter() - start
+        start = time.perf_counter()
+        expected = [toolpath.toolpath_layer(messages.LayerOptimized.loads(payload, FIELDS)) for payload in payloads]
+        local = time.perf_counter() - start
+        matching = all(same_layer(shared.layer, layer) for shared, layer in zip(shared_layers, expected))
+        for shared in shared_layers:
+            shared.release()
+    finally:
+        decoder.shutdown()
+    print('%d layers, %d points' % (len(payloads), sum(layer.point_count() for layer in expected)))
+    print('  toolpath_layer      %8.1f ms' % (local * 1000))
+    print('  LayerDecoder (%d)    %8.1f ms  x%.1f  %s' % (args.processes, decoded * 1000, local / decoded,
+                                                         'same layers' if matching else 'DIFFERENT LAYERS'))
+    if not matching:
+        sys.exit('LayerDecoder and toolpath_layer disagree')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+'''
+Replays an engine capture through run_engine and times the stages of the
+slice command: receiving, decoding, splitting the layers in strips and
+collecting the G-code. No CuraEngine is needed.
+
+usage: python bench/bench_replay.py [capture.fcc] [--layers N] [--speed S]
+
+Captures are recorded by setting engine_capture_dir in the FusedCura
+configuration. Without a capture, a synthetic one is generated. --speed
+replays at S times the recorded pace, by default as fast as possible.
+'''
+import argparse
+import os
+import tempfile
+import time
+
+from common import load_package, import_from, make_layer, make_slice
+
+
+def make_capture(messages, enginecapture, path, layer_count):
+    symbols = messages.symbol_message_dict
+    with enginecapture.CaptureWriter(path) as capture:
+        prefix = symbols['cura.proto.GCodePrefix']
+        capture.record(prefix, prefix.dumps(messages.GCodePrefix(data=b';FLAVOR:Marlin\n')))
+        for layer_id in range(layer_count):
+            layer_type = symbols['cura.proto.LayerOptimized']
+            capture.record(layer_type, layer_type.dumps(make_layer(messages, layer_id, segment_count=500, seed=layer_id)))
+            capture.record(None, b'')
+            gcode_type = symbols['cura.proto.GCodeLayer']
+            gcode = ''.join('G1 X%d Y%d E%d\n' % (i, i, i) for i in range(5000)).encode()
+            capture.record(gcode_type, gcode_type.dumps(messages.GCodeLayer(data=gcode)))
+        estimates = symbols['cura.proto.PrintTimeMaterialEstimates']
+        capture.record(estimates, estimates.dumps(messages.PrintTimeMaterialEstimates(time_infill=600.0)))
+        finished = symbols['cura.proto.SlicingFinished']
+        capture.record(finished, finished.dumps(messages.SlicingFinished()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('capture', nargs='?')
+    parser.add_argument('--layers', type=int, default=100)
+    parser.add_argument('--speed', type=float, default=None)
+    args = parser.parse_args()
+    load_package()
+    messages = import_from('FusedCura', 'messages')
+    curaengine = import_from('FusedCura', 'curaengine')
+    enginecapture = import_from('FusedCura', 'enginecapture')
+    toolpath = import_from('FusedCura', 'toolpath')
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.capture
+        if not path:
+            path = os.path.join(directory, 'synthetic.fcc')
+            make_capture(messages, enginecapture, path, args.layers)
+        launcher = enginecapture.ReplayEngine(path, args.speed)
+        slice_msg = make_slice(messages, vertex_count=1000)
+        config = {'curaengine': 'replay'}
+
+        received = []
+        start = time.perf_counter()
+        curaengine.run_engine(slice_msg, lambda payload, type_def: received.append((type_def, payload)),
+                              config=config, launcher=launcher)
+        timings = {'receive': time.perf_counter() - start}
+
+        start = time.perf_counter()
+        decoded = [(type_def.symbol, type_def.loads(payload)) for type_def, payload in received]
+        timings['decode'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for symbol, message in decoded:
+            if symbol == 'cura.proto.LayerOptimized':
+                toolpath.toolpath_layer(message)
+        timings['strips'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with tempfile.TemporaryFile() as gcode_collector:
+            for symbol, message in decoded:
+                if symbol == 'cura.proto.GCodeLayer':
+                    gcode_collector.write(message.data)
+        timings['gcode'] = time.perf_counter() - start
+
+        size = sum(len(payload) for _, payload in received)
+        print('%d frames, %.2f MB from %s' % (len(received), size / 1e6, args.capture or 'a synthetic capture'))
+        for stage, seconds in timings.items():
+            print('%-8s %9.1f ms' % (stage, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
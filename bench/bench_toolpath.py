@@ -0,0 +1,161 @@
+'''
+Compares toolpath.segment_points with the previous conversion of the layer
+points to centimetres: the curaengine.parse_segment generator followed by a
+division of every coordinate, on dense synthetic layers. Then compares
+toolpath.toolpath_layer with the previous per point split in strips, and
+checks that they give the same strips, also on short segments whose
+line_type and points have different lengths. Last, times the levels of
+detail of toolpath.simplify_strips on a layer of round perimeters and counts
+the lines left at each level. The array fallback is measured too when numpy
+is installed.
+
+usage: python bench/bench_toolpath.py [--segments N] [--points N]
+'''
+import argparse
+import math
+import random
+from array import array
+from collections import defaultdict
+
+from common import load_package, import_from, make_layer, best_of
+
+
+def legacy_points(curaengine, layer):
+    points = []
+    for segment in layer.path_segment:
+        coord_iterator = iter(curaengine.parse_segment(segment, layer.height))
+        points.append([(x / 10, next(coord_iterator) / 10, next(coord_iterator) / 10) for x in coord_iterator])
+    return points
+
+
+def legacy_strips_by_type(curaengine, layer):
+    line_strips_per_type = defaultdict(list)
+    for segment in layer.path_segment:
+        coord_iterator = iter(curaengine.parse_segment(segment, layer.height))
+        current_list = []
+        current_type = None
+        for type, point_x in zip(segment.line_type, coord_iterator):
+            point = point_x / 10, next(coord_iterator) / 10, next(coord_iterator) / 10
+            if len(current_list):
+                current_list.extend(point)
+            if type != current_type:
+                current_list = []
+                current_list.extend(point)
+                current_type = type
+                line_strips_per_type[current_type].append(current_list)
+    return {type: {'strip_lengths': [len(strip) // 3 for strip in strips],
+                   'giant_strip': [coord for strip in strips for coord in strip]}
+            for type, strips in line_strips_per_type.items()}
+
+
+def same_strips(layer, legacy):
+    def lengths(first, end):
+        return [layer.offsets[index + 1] - layer.offsets[index] for index in range(first, end)]
+
+    def coords(first, end):
+        return layer.coords[layer.offsets[first] * 3:layer.offsets[end] * 3].tolist()
+
+    return list(layer.line_types()) == list(legacy) and all(
+        lengths(*layer.ranges[type]) == legacy[type]['strip_lengths']
+        and coords(*layer.ranges[type]) == array('f', legacy[type]['giant_strip']).tolist()
+        for type in legacy)
+
+
+def ragged_layer(messages, seed=1):
+    rnd = random.Random(seed)
+    layer = messages.LayerOptimized(id=0, height=200.0, thickness=200.0)
+    segments = []
+    for _ in range(300):
+        point_count = rnd.randint(0, 6)
+        segment = messages.PathSegment(point_type=0)
+        segment.points = array('f', (rnd.uniform(0, 200) for _ in range(point_count * 2))).tobytes()
+        segment.line_type = bytes(rnd.choice((1, 1, 2, 5)) for _ in range(max(0, point_count + rnd.randint(-2, 2))))
+        segments.append(segment)
+    layer.path_segment = segments
+    return messages.LayerOptimized.loads(messages.LayerOptimized.dumps(layer))
+
+
+def perimeters_layer(messages, count=100, points=400, seed=1):
+    # closed loops of small segments, like the walls of round parts
+    rnd = random.Random(seed)
+    layer = messages.LayerOptimized(id=0, height=200.0, thickness=200.0)
+    segments = []
+    for _ in range(count):
+        x, y, radius = rnd.uniform(0, 2000), rnd.uniform(0, 2000), rnd.uniform(5, 200)
+        segment = messages.PathSegment(point_type=0)
+        segment.points = array('f', (coord for index in range(points + 1)
+                                     for coord in (x + radius * math.cos(2 * math.pi * index / points),
+                                                   y + radius * math.sin(2 * math.pi * index / points)))).tobytes()
+        segment.line_type = bytes([1, 2][index * 2 // (points + 1)] for index in range(points + 1))
+        segments.append(segment)
+    layer.path_segment = segments
+    return messages.LayerOptimized.loads(messages.LayerOptimized.dumps(layer))
+
+
+def flat(coords):
+    return coords.reshape(-1).tolist() if hasattr(coords, 'reshape') else coords.tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--segments', type=int, default=2000)
+    parser.add_argument('--points', type=int, default=100)
+    args = parser.parse_args()
+    load_package()
+    messages = import_from('FusedCura', 'messages')
+    curaengine = import_from('FusedCura', 'curaengine')
+    toolpath = import_from('FusedCura', 'toolpath')
+    implementations = [('numpy' if toolpath.numpy else 'array', toolpath.numpy)]
+    if toolpath.numpy:
+        implementations.append(('array', None))
+    for point_type in (0, 1):
+        layer = make_layer(messages, segment_count=args.segments, points_per_segment=args.points,
+                           point_type=point_type)
+        layer = messages.LayerOptimized.loads(messages.LayerOptimized.dumps(layer))
+        point_count = args.segments * args.points
+        legacy = best_of(lambda: legacy_points(curaengine, layer))
+        print('%dD layer, %d points' % (2 if point_type == 0 else 3, point_count))
+        print('  generator  %8.2f ms  %6.1f Mpoints/s' % (legacy * 1000, point_count / legacy / 1e6))
+        expected = array('f', [coord for segment in legacy_points(curaengine, layer) for point in segment
+                               for coord in point]).tolist()
+        for label, module in implementations:
+            toolpath.numpy = module
+            seconds = best_of(lambda: [toolpath.segment_points(segment, layer.height)
+                                       for segment in layer.path_segment])
+            coords = [coord for segment in layer.path_segment
+                      for coord in flat(toolpath.segment_points(segment, layer.height))]
+            matching = coords == expected
+            print('  %-9s  %8.2f ms  %6.1f Mpoints/s  x%.1f  %s' % (
+                label, seconds * 1000, point_count / seconds / 1e6, legacy / seconds,
+                'same values' if matching else 'DIFFERENT VALUES'))
+        legacy = best_of(lambda: legacy_strips_by_type(curaengine, layer))
+        print('  strips by type')
+        print('  per point  %8.2f ms  %6.1f Mpoints/s' % (legacy * 1000, point_count / legacy / 1e6))
+        expected = legacy_strips_by_type(curaengine, layer)
+        for label, module in implementations:
+            toolpath.numpy = module
+            seconds = best_of(lambda: toolpath.toolpath_layer(layer))
+            matching = same_strips(toolpath.toolpath_layer(layer), expected) and all(
+                same_strips(toolpath.toolpath_layer(ragged), legacy_strips_by_type(curaengine, ragged))
+                for ragged in (ragged_layer(messages, seed) for seed in range(5)))
+            print('  %-9s  %8.2f ms  %6.1f Mpoints/s  x%.1f  %s' % (
+                label, seconds * 1000, point_count / seconds / 1e6, legacy / seconds,
+                'same strips' if matching else 'DIFFERENT STRIPS'))
+        toolpath.numpy = implementations[0][1]
+    layer = perimeters_layer(messages)
+    print('levels of detail, perimeters of %d points' % sum(len(segment.line_type) for segment in layer.path_segment))
+    for label, module in implementations:
+        toolpath.numpy = module
+        toolpath_layer = toolpath.toolpath_layer(layer)
+        for level, tolerance in enumerate(toolpath.LOD_TOLERANCES[1:], 1):
+            seconds = best_of(lambda: [toolpath.simplify_strips(toolpath_layer.coords,
+                                                                toolpath_layer.offsets[first:end + 1], tolerance)
+                                       for first, end in toolpath_layer.ranges.values()], repeat=3)
+            print('  %-9s  level %d  %8.2f ms  %6d lines of %d' % (
+                label, level, seconds * 1000, toolpath_layer.segment_count(level=level),
+                toolpath_layer.segment_count()))
+    toolpath.numpy = implementations[0][1]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Times receiving a large LayerOptimized stream from the engine connection over
+the loopback TCP socket and over a Unix domain socket.
+
+usage: python bench/bench_transport.py [layer_count]
+
+The stream is sent by a thread of this process and parsed with the
+FrameParser of curaengine, like run_engine does.
+'''
+import socket
+import struct
+import sys
+import threading
+import time
+
+from common import load_package, import_from, make_layer
+
+
+def connect(address):
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return socket.create_connection((host, int(port)))
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client_socket.connect(address)
+    return client_socket
+
+
+def receive(curaengine, transport, stream):
+    with curaengine.engine_listener({'engine_transport': transport}) as (server_socket, address):
+        def send():
+            with connect(address) as client_socket:
+                client_socket.sendall(stream)
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        connection, _ = server_socket.accept()
+        start = time.perf_counter()
+        with connection:
+            parser = curaengine.FrameParser()
+            count = 0
+            while not parser.done:
+                frames = parser.receive(connection)
+                if frames is None:
+                    break
+                count += len(frames)
+        seconds = time.perf_counter() - start
+        sender.join()
+    return seconds, count, address
+
+
+def main():
+    layer_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    load_package()
+    messages = import_from('FusedCura', 'messages')
+    curaengine = import_from('FusedCura', 'curaengine')
+    layer_type = messages.LayerOptimized
+    stream = bytearray()
+    for layer_id in range(layer_count):
+        payload = make_layer(messages, layer_id, seed=layer_id).dumps()
+        stream += struct.pack('!III', curaengine._SIGNATURE, len(payload), layer_type.hash) + payload
+    stream += struct.pack('>I', curaengine._CLOSE_SOCKET)
+    transports = ['tcp', 'unix'] if hasattr(socket, 'AF_UNIX') else ['tcp']
+    for transport in transports:
+        seconds, count, address = min(receive(curaengine, transport, stream) for _ in range(5))
+        print('%-5s %-40s %5d frames %8.2f MB %8.1f ms %8.1f MB/s' % (
+            transport, address, count, len(stream) / 1e6, seconds * 1000, len(stream) / seconds / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+'''
+Compares the buffer varint functions of lib/protobuf.py with the previous
+byte-at-a-time stream implementation.
+
+usage: python bench/bench_varint.py
+'''
+from io import BytesIO
+
+from common import load_package, import_from, best_of
+
+
+def legacy_dump(fp, value):
+    shifted_value = True
+    while shifted_value:
+        shifted_value = value >> 7
+        fp.write(((value & 0x7F) | (0x80 if shifted_value != 0 else 0x00)).to_bytes(1, byteorder='big'))
+        value = shifted_value
+
+
+def legacy_load(fp):
+    value, shift, quantum = 0, 0, 0x80
+    while (quantum & 0x80) == 0x80:
+        quantum = int.from_bytes(fp.read(1), byteorder='big')
+        value, shift = value + ((quantum & 0x7F) << shift), shift + 7
+    return value
+
+
+def main():
+    load_package()
+    protobuf = import_from('FusedCura', 'lib.protobuf')
+    for label, values in [('1 byte', [5, 17, 100, 127] * 2500), ('2-3 bytes', [300, 4000, 70000, 1 << 20] * 2500),
+                          ('5+ bytes', [1 << 32, 1 << 40, 0xf0f0f0f0, 1 << 56] * 2500)]:
+        fp = BytesIO()
+        for value in values:
+            legacy_dump(fp, value)
+        encoded = fp.getvalue()
+
+        def legacy_encode():
+            out = BytesIO()
+            for v in values:
+                legacy_dump(out, v)
+
+        def fast_encode():
+            buffer = bytearray(sum(protobuf.uvarint_size(v) for v in values))
+            offset = 0
+            for v in values:
+                offset = protobuf.encode_uvarint_into(buffer, offset, v)
+
+        def legacy_decode():
+            stream = BytesIO(encoded)
+            for _ in values:
+                legacy_load(stream)
+
+        def fast_decode():
+            view, offset = memoryview(encoded), 0
+            for _ in values:
+                _, offset = protobuf.decode_uvarint(view, offset)
+
+        for operation, legacy, fast in [('encode', legacy_encode, fast_encode), ('decode', legacy_decode, fast_decode)]:
+            legacy_time, fast_time = best_of(legacy), best_of(fast)
+            print('%-9s %s  legacy: %7.2f ns/varint  buffer: %7.2f ns/varint  speedup: %.2fx' % (
+                label, operation, legacy_time / len(values) * 1e9, fast_time / len(values) * 1e9,
+                legacy_time / fast_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+'''
+Helpers shared by the benchmark scripts: loading a FusedCura checkout as a
+package outside of Fusion 360 and building synthetic CuraEngine payloads.
+'''
+import array
+import importlib
+import importlib.machinery
+import importlib.util
+import os
+import random
+import sys
+import timeit
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_package(path=REPO, name='FusedCura'):
+    '''
+    Registers the checkout at path as the package name, so that its relative imports work, and returns it.
+    '''
+    spec = importlib.machinery.ModuleSpec(name, None, is_package=True)
+    package = importlib.util.module_from_spec(spec)
+    package.__path__ = [os.path.abspath(path)]
+    sys.modules[name] = package
+    return package
+
+
+def import_from(name, module):
+    return importlib.import_module(name + '.' + module)
+
+
+def make_slice(messages, vertex_count=300000, setting_count=600, extruder_count=2, seed=1):
+    rnd = random.Random(seed)
+    settings = {'setting_%d' % i: rnd.random() for i in range(setting_count)}
+    slice_msg = messages.Slice()
+    slice_msg.global_settings = messages.dict_to_setting_list(settings)
+    extruders = []
+    for i in range(extruder_count):
+        extruder = messages.Extruder()
+        extruder.id = i
+        extruder.settings = messages.dict_to_setting_list(settings)
+        extruders.append(extruder)
+    slice_msg.extruders = extruders
+    obj = messages.Object()
+    obj.id = 1
+    obj.vertices = array.array('f', (rnd.uniform(0, 2000) for _ in range(vertex_count * 3))).tobytes()
+    object_list = messages.ObjectList()
+    object_list.objects = [obj]
+    slice_msg.object_lists = [object_list]
+    return slice_msg
+
+
+def make_layer(messages, layer_id=10, segment_count=2000, points_per_segment=40, point_type=0, seed=1):
+    rnd = random.Random(seed)
+    dimensions = 2 if point_type == 0 else 3
+    layer = messages.LayerOptimized()
+    layer.id = layer_id
+    layer.height = 200.0 * (layer_id + 1)
+    layer.thickness = 200.0
+    segments = []
+    for _ in range(segment_count):
+        segment = messages.PathSegment()
+        segment.extruder = 0
+        segment.point_type = point_type
+        segment.points = array.array('f', (rnd.uniform(0, 200) for _ in range(points_per_segment * dimensions))).tobytes()
+        line_type = bytearray()
+        while len(line_type) < points_per_segment:
+            line_type += bytes([rnd.randint(1, 10)]) * rnd.randint(1, 12)
+        segment.line_type = bytes(line_type[:points_per_segment])
+        segment.line_width = array.array('f', [0.4] * points_per_segment).tobytes()
+        segment.line_thickness = array.array('f', [0.2] * points_per_segment).tobytes()
+        segment.line_feedrate = array.array('f', [60.0] * points_per_segment).tobytes()
+        segments.append(segment)
+    layer.path_segment = segments
+    return layer
+
+
+def best_of(function, repeat=5, number=1):
+    '''
+    Returns the best wall time in seconds of a single call of function.
+    '''
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number
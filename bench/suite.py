@@ -0,0 +1,120 @@
+'''
+Protobuf codec benchmark suite on synthetic CuraEngine payloads.
+
+usage: python bench/suite.py [--quick] [--output results.json] [--compare previous.json]
+
+Measures encode and decode throughput (MB/s, messages/s), the peak memory
+traced during one operation and the number of memory blocks still allocated
+after it (the decoded message), and saves them as JSON. With --compare, the
+throughputs are printed next to a previous result file.
+'''
+import argparse
+import gc
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from common import REPO, load_package, import_from, make_slice, make_layer, best_of
+
+
+def payloads(messages, quick):
+    scale = 10 if quick else 1
+    layers_2d = [make_layer(messages, layer_id=i, segment_count=3000 // scale, point_type=0, seed=i) for i in range(3)]
+    layers_3d = [make_layer(messages, layer_id=i, segment_count=3000 // scale, point_type=1, seed=i) for i in range(3)]
+    return {
+        'Slice': (messages.Slice, [make_slice(messages, vertex_count=1000000 // scale, setting_count=600,
+                                              extruder_count=3)]),
+        'LayerOptimized 2D': (messages.LayerOptimized, layers_2d),
+        'LayerOptimized 3D': (messages.LayerOptimized, layers_3d),
+    }
+
+
+def memory_use(function):
+    '''
+    Returns (peak traced bytes, blocks still allocated) for one call of function.
+    '''
+    gc.collect()
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    result = function()
+    retained = sys.getallocatedblocks() - blocks
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak, retained
+
+
+def measure(message_type, message_list, repeat):
+    raw_list = [message_type.dumps(message) for message in message_list]
+    total_bytes = sum(len(raw) for raw in raw_list)
+    operations = {
+        'encode dumps': lambda: [message_type.dumps(message) for message in message_list],
+        'encode dump_chunks': lambda: [message_type.dump_chunks(message) for message in message_list],
+        'decode loads': lambda: [message_type.loads(raw) for raw in raw_list],
+        'decode lazy_loads': lambda: [message_type.lazy_loads(raw) for raw in raw_list],
+        'decode lazy_loads + decode_all': lambda: [message_type.lazy_loads(raw).decode_all() for raw in raw_list],
+    }
+    results = {}
+    for name, operation in operations.items():
+        seconds = best_of(operation, repeat=repeat)
+        peak, retained = memory_use(operation)
+        results[name] = {
+            'seconds': seconds,
+            'mb_per_s': total_bytes / seconds / 1e6,
+            'messages_per_s': len(message_list) / seconds,
+            'peak_bytes': peak,
+            'retained_blocks': retained,
+        }
+    return {'payload_bytes': total_bytes, 'messages': len(message_list), 'operations': results}
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPO,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='smaller payloads and fewer repeats')
+    parser.add_argument('--output', help='JSON result file, defaults to bench_results-<revision>.json')
+    parser.add_argument('--compare', help='previous JSON result file')
+    args = parser.parse_args()
+    load_package()
+    messages = import_from('FusedCura', 'messages')
+    results = {
+        'revision': revision(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': args.quick,
+        'benchmarks': {name: measure(message_type, message_list, 3 if args.quick else 7)
+                       for name, (message_type, message_list) in payloads(messages, args.quick).items()},
+    }
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['benchmarks']
+    for name, benchmark in results['benchmarks'].items():
+        print('%s: %d messages, %.1f MB' % (name, benchmark['messages'], benchmark['payload_bytes'] / 1e6))
+        for operation, result in benchmark['operations'].items():
+            line = '  %-32s %9.1f MB/s %9.1f msg/s %12d peak B %9d retained blocks' % (
+                operation, result['mb_per_s'], result['messages_per_s'], result['peak_bytes'],
+                result['retained_blocks'])
+            old = previous and previous.get(name, {}).get('operations', {}).get(operation)
+            if old:
+                line += '   %+.0f%%' % ((result['mb_per_s'] / old['mb_per_s'] - 1) * 100)
+            print(line)
+    output = args.output or 'bench_results-%s.json' % (results['revision'] or 'unknown')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('saved', output)
+
+
+if __name__ == '__main__':
+    main()
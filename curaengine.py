@@ -1,15 +1,17 @@
 import array
 import os
+import shutil
+import signal
 import socket
 import struct
-from contextlib import closing
-from datetime import datetime
-from os.path import dirname
-from subprocess import Popen
+import tempfile
+import time
+from contextlib import closing, contextmanager
+from subprocess import Popen, DEVNULL, PIPE, STDOUT, call
 
-from .lib.appdirs import user_log_dir
+from .enginecapture import open_capture
+from .enginelog import EngineLog, engine_log_file
 from .messages import hash_message_dict, symbol_message_dict, Slice
-from .settings import read_configuration, fdmprinterfile
 
 # _exec_file = '/Applications/Ultimaker Cura.app/Contents/MacOS/CuraEngine'
 # _settings_file = '/Applications/Ultimaker Cura.app/Contents/MacOS/resources/definitions/fdmprinter.def.json'
@@ -18,78 +20,321 @@ TIME_KEYS = ['float time_none', 'time_inset_0', 'time_inset_x', 'time_skin', 'ti
              'time_skirt =', 'time_infill', 'time_support_infill', 'time_travel', 'time_retract',
              'time_support_interface']
 
-engine_log_file = os.path.join(user_log_dir('FusedCura', 'nraynaud'), 'engine.log')
-os.makedirs(dirname(engine_log_file), exist_ok=True)
 print(engine_log_file)
 
 _SIGNATURE = 0x2BAD << 16 | 1 << 8
 _CLOSE_SOCKET = 0xf0f0f0f0
+_IOV_MAX = 1024  # sendmsg() buffer count limit on the POSIX systems.
+UNIX_CONNECT_TIMEOUT = 10  # seconds, see engine_listener()
 
 
-def recvall(sock, n):
-    # Helper function to recv n bytes or return None if EOF is hit
-    data = b''
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
+_WORD = struct.Struct('>I')
+_FRAME_HEADER = struct.Struct('>III')
+
+
+class FrameParser:
+    # Incremental parser of the engine socket framing: accepts the received bytes in chunks of any size and returns
+    # the complete (type_def, payload) frames, (None, b'') for a keep-alive.
+    # The bytes are accumulated in a single buffer growing and compacting in place.
+    READ_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.buffer = bytearray(self.READ_SIZE)
+        self.start = 0  # first unparsed byte of the buffer
+        self.end = 0  # end of the received bytes in the buffer
+        self.closed = False  # the engine sent _CLOSE_SOCKET
+        self.done = False  # no frame will follow, after _CLOSE_SOCKET or an unexpected word
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return self.frames()
+
+    def receive(self, sock):
+        # reads what's available on sock straight into the buffer, returns None at the end of the stream
+        self.reserve(max(self.READ_SIZE, self.missing()))
+        with memoryview(self.buffer) as view:
+            count = sock.recv_into(view[self.end:])
+        if not count:
             return None
-        data += packet
-    return data
-
-
-def run_engine(slice_message: Slice, event_handler, child_started_handler=None, keep_alive_handler=None):
-    with open(engine_log_file, 'a+') as log_file:
-        print(datetime.now(), file=log_file, flush=True)
-        encoded_message = Slice.dumps(slice_message)
-        config = read_configuration()
-        print(dict(config), file=log_file, flush=True)
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as server_socket:
-            server_socket.bind(('127.0.0.1', 0))
-            server_socket.listen(5)
-            name = server_socket.getsockname()
-            extra_params = {}
-            if os.name == 'nt':
-                from subprocess import STARTUPINFO, STARTF_USESHOWWINDOW
-                info = STARTUPINFO()
-                info.dwFlags |= STARTF_USESHOWWINDOW
-                extra_params['startupinfo'] = info
-            cmd = ' '.join(['"' + config['curaengine'] + '"', 'connect', "%s:%s" % name, '-j',
-                            '"' + fdmprinterfile + '"'])
-            print(cmd, file=log_file, flush=True)
-            child_process = Popen(cmd, stdout=log_file, stderr=log_file, **extra_params, shell=True)
-            if child_started_handler:
-                child_started_handler(child_process)
+        self.end += count
+        return self.frames()
+
+    def missing(self):
+        # count of bytes still needed to complete the frame being received
+        available = self.end - self.start
+        if available < _FRAME_HEADER.size or _WORD.unpack_from(self.buffer, self.start)[0] != _SIGNATURE:
+            return 0
+        return _FRAME_HEADER.size + _WORD.unpack_from(self.buffer, self.start + 4)[0] - available
+
+    def reserve(self, length):
+        if self.start == self.end:
+            self.start = self.end = 0
+        if self.end + length <= len(self.buffer):
+            return
+        if self.start:
+            pending = self.end - self.start
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        if self.end + length > len(self.buffer):
+            self.buffer.extend(bytes(max(self.end + length, 2 * len(self.buffer)) - len(self.buffer)))
+
+    def frames(self):
+        frames = []
+        buffer = self.buffer
+        while not self.done and self.end - self.start >= _WORD.size:
+            word = _WORD.unpack_from(buffer, self.start)[0]
+            if word == _SIGNATURE:
+                if self.end - self.start < _FRAME_HEADER.size:
+                    break
+                _, size, type_id = _FRAME_HEADER.unpack_from(buffer, self.start)
+                payload_start = self.start + _FRAME_HEADER.size
+                if payload_start + size > self.end:
+                    break
+                with memoryview(buffer) as view:
+                    payload = view[payload_start:payload_start + size].tobytes()
+                frames.append((hash_message_dict[type_id], payload))
+                self.start = payload_start + size
+            else:
+                self.start += _WORD.size
+                if word == 0:
+                    frames.append((None, b''))
+                else:
+                    self.closed = word == _CLOSE_SOCKET
+                    self.done = True
+        return frames
+
+
+def send_chunks(sock, chunks):
+    # Sends all the chunks without concatenating them, with scatter-gather I/O where the platform has it
+    if not hasattr(sock, 'sendmsg'):
+        for chunk in chunks:
+            sock.sendall(chunk)
+        return
+    pending = [memoryview(chunk).cast('B') for chunk in chunks if len(chunk)]
+    index = 0
+    while index < len(pending):
+        sent = sock.sendmsg(pending[index:index + _IOV_MAX])
+        while sent:
+            if sent >= len(pending[index]):
+                sent -= len(pending[index])
+                index += 1
+            else:
+                pending[index] = pending[index][sent:]
+                sent = 0
+
+
+@contextmanager
+def engine_listener(config):
+    # yields the listening socket the engine connects to and its address for the engine command line.
+    # With engine_transport = unix in the configuration, it's a Unix domain socket where the platform has them,
+    # a TCP socket on the loopback otherwise. The unix transport needs a CuraEngine patched to connect to a socket
+    # path, the stock one only connects to host:port, so EngineHandle.connect() falls back to TCP when the engine
+    # didn't connect within UNIX_CONNECT_TIMEOUT.
+    if config.get('engine_transport', 'tcp') == 'unix' and hasattr(socket, 'AF_UNIX'):
+        directory = tempfile.mkdtemp(prefix='FusedCura')
+        try:
+            path = os.path.join(directory, 'engine.sock')
+            with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as server_socket:
+                try:
+                    server_socket.bind(path)
+                except OSError:
+                    pass
+                else:
+                    server_socket.listen(5)
+                    yield server_socket, path
+                    return
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as server_socket:
+        server_socket.bind(('127.0.0.1', 0))
+        server_socket.listen(5)
+        yield server_socket, '%s:%s' % server_socket.getsockname()
+
+
+def connect_timeout(server_socket, timeout=None):
+    # the longest wait in seconds for the engine to connect to server_socket, None for no limit
+    if server_socket.family != getattr(socket, 'AF_UNIX', None):
+        return timeout
+    return UNIX_CONNECT_TIMEOUT if timeout is None else min(timeout, UNIX_CONNECT_TIMEOUT)
+
+
+def engine_arguments(config, address):
+    from .settings import fdmprinterfile
+    return [config['curaengine'], 'connect', address, '-j', fdmprinterfile]
+
+
+def engine_process_params():
+    # the engine gets its own process group, so that kill_engine() reaches it through the shell
+    extra_params = {}
+    if os.name == 'nt':
+        from subprocess import STARTUPINFO, STARTF_USESHOWWINDOW, CREATE_NEW_PROCESS_GROUP
+        info = STARTUPINFO()
+        info.dwFlags |= STARTF_USESHOWWINDOW
+        extra_params['startupinfo'] = info
+        extra_params['creationflags'] = CREATE_NEW_PROCESS_GROUP
+    else:
+        extra_params['start_new_session'] = True
+    return extra_params
+
+
+def kill_engine(process):
+    # kills the engine, the shell running it and anything else in its process group
+    if process.poll() is not None:
+        return
+    if process.pid is None:  # a stand-in, see enginecapture.ReplayProcess
+        process.terminate()
+    elif os.name == 'nt':
+        call(['taskkill', '/F', '/T', '/PID', str(process.pid)], stdout=DEVNULL, stderr=DEVNULL,
+             startupinfo=engine_process_params()['startupinfo'])
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def shutdown_socket(sock):
+    # wakes up a thread blocked on the socket, it gets the end of the stream
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class EngineHandle:
+    # Given to child_started_handler, terminate() stops a running engine within about ACCEPT_POLL seconds: it kills
+    # the engine process group and shuts its sockets down, so that run_engine returns without waiting for a frame.
+    # log is the EngineLog of the job, like EngineWorker.log.
+    ACCEPT_POLL = 0.1
+
+    def __init__(self, process, *sockets, log=None):
+        self.process = process
+        self.sockets = list(sockets)
+        self.log = log
+        self.terminated = False
+
+    def connect(self, config, launcher, timeout=None):
+        # launches the engine and returns its connection like accept(). An engine that didn't connect to a Unix domain
+        # socket within UNIX_CONNECT_TIMEOUT or exited is launched again on TCP, see engine_listener().
+        while True:
+            with engine_listener(config) as (server_socket, address):
+                if self.terminated:
+                    return None
+                self.process = launcher(config, address, self.log)
+                self.sockets.append(server_socket)
+                if self.terminated:
+                    kill_engine(self.process)  # terminate() ran before the process was set
+                    return None
+                self.log.info('engine started %s %s', self.process.pid, self.process.poll())
+                try:
+                    return self.accept(server_socket, connect_timeout(server_socket, timeout))
+                except (socket.timeout, ChildProcessError) as error:
+                    if server_socket.family != getattr(socket, 'AF_UNIX', None):
+                        raise
+                    self.log.info('no connection on %s (%s), launching the engine again on TCP', address, error)
+                    kill_engine(self.process)
+                    self.process.wait()
+            config = dict(config, engine_transport='tcp')
+
+    def accept(self, server_socket, timeout=None):
+        # returns the engine connection, None when terminated before the engine connected, raises socket.timeout
+        # when the engine did not connect within timeout seconds and ChildProcessError when it exited first
+        server_socket.settimeout(self.ACCEPT_POLL)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.terminated:
             try:
-                print(child_process, file=log_file, flush=True)
-                print(child_process.poll(), file=log_file, flush=True)
-                (client_socket, address) = server_socket.accept()
-                client_socket.send(struct.pack("I", socket.htonl(_SIGNATURE)))
-                client_socket.send(struct.pack("!I", len(encoded_message)))
-                client_socket.send(struct.pack("!I", symbol_message_dict['cura.proto.Slice'].hash))
-                client_socket.send(encoded_message)
-                while 1:
-                    process = client_socket.recv(4)
-                    if len(process) == 4:
-                        unpacked = struct.unpack('>I', process)[0]
-                        if unpacked == 0:
-                            if keep_alive_handler:
-                                keep_alive_handler()
-                            continue
-                        if unpacked == _CLOSE_SOCKET:
-                            print('_CLOSE_SOCKET')
-                            return
-                        if unpacked == _SIGNATURE:
-                            size = struct.unpack('>I', client_socket.recv(4))[0]
-                            type_id = struct.unpack('>I', client_socket.recv(4))[0]
-                            type_def = hash_message_dict[type_id]
-                            res3 = recvall(client_socket, size) if size else b''
-                            event_handler(res3, type_def)
-                            continue
-                        break
+                (connection, address) = server_socket.accept()
+            except socket.timeout:
+                if self.process is not None and self.process.poll() is not None:
+                    raise ChildProcessError('CuraEngine exited with %s before connecting' % self.process.poll())
+                if deadline is not None and time.monotonic() > deadline:
+                    raise
+                continue
+            except OSError:
+                if self.terminated:
+                    break
+                raise
+            connection.settimeout(None)
+            self.sockets.append(connection)
+            if self.terminated:
+                shutdown_socket(connection)
+            return connection
+        return None
+
+    def terminate(self):
+        self.terminated = True
+        for sock in self.sockets:
+            shutdown_socket(sock)
+        if self.process:
+            kill_engine(self.process)
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+
+def spawn_engine(config, address, log):
+    # log is the EngineLog receiving the engine output
+    cmd = ' '.join('"' + argument + '"' for argument in engine_arguments(config, address))
+    log.info('%s', cmd)
+    process = Popen(cmd, stdout=PIPE, stderr=STDOUT, **engine_process_params(), shell=True)
+    log.pump(process.stdout)
+    return process
+
+
+def slice_header(encoded_chunks):
+    return struct.pack('!III', _SIGNATURE, sum(len(chunk) for chunk in encoded_chunks),
+                       symbol_message_dict['cura.proto.Slice'].hash)
+
+
+def run_engine(slice_message: Slice, event_handler, child_started_handler=None, keep_alive_handler=None, config=None,
+               launcher=spawn_engine, capture_file=None, metrics=None):
+    # launcher starts the engine, see enginecapture.ReplayEngine for a stand-in
+    # capture_file records the received frames, see enginecapture
+    # metrics counts the received frames, see enginemetrics.EngineMetrics
+    if metrics:
+        metrics.session()
+    log = EngineLog()
+    log.start_job()
+    with open_capture(capture_file) as capture:
+        encoded_chunks = Slice.dump_chunks(slice_message)
+        if config is None:
+            from .settings import read_configuration
+            config = read_configuration()
+        log.info('configuration %s', dict(config))
+        engine = EngineHandle(None, log=log)
+        if child_started_handler:
+            child_started_handler(engine)  # before the launch, so that the engine can be terminated while it starts
+        try:
+            client_socket = engine.connect(config, launcher)
+            if client_socket is None:
+                return
+            send_chunks(client_socket, [slice_header(encoded_chunks)] + encoded_chunks)
+            if capture:
+                capture.start = time.perf_counter()
+            parser = FrameParser()
+            while not parser.done:
+                frames = parser.receive(client_socket)
+                if frames is None:
+                    break
+                for type_def, payload in frames:
+                    if capture:
+                        capture.record(type_def, payload)
+                    if metrics:
+                        metrics.received(type_def, len(payload))
+                    if type_def is None:
+                        if keep_alive_handler:
+                            keep_alive_handler()
                     else:
-                        break
-            finally:
-                print(child_process.communicate(), file=log_file, flush=True)
+                        event_handler(payload, type_def)
+            if parser.closed:
+                print('_CLOSE_SOCKET')
+        finally:
+            engine.close()
+            if engine.process:
+                log.info('engine exited %s', engine.process.wait())
 
 
 def _2_to_3(point2d_array, height):
@@ -102,7 +347,8 @@ def _2_to_3(point2d_array, height):
 
 
 def parse_segment(segment, height):
-    floats = array.array('f', segment.points)
+    floats = array.array('f')
+    floats.frombytes(segment.points)  # points is a memoryview into the received frame.
     if segment.point_type == 0:
         return _2_to_3(floats, height / 1000)
     else:
@@ -0,0 +1,136 @@
+import os
+import socket
+import struct
+import threading
+import time
+from contextlib import closing, nullcontext
+from datetime import datetime
+
+# A capture file is _MAGIC followed by a record per frame received from the engine: the little endian
+# (seconds since the Slice was sent, type hash, payload length) then the payload. Keep-alives have the type hash 0.
+_MAGIC = b'FCCAP\x00\x00\x01'
+_RECORD = struct.Struct('<dII')
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(_MAGIC)
+        self.start = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, type_def, payload):
+        self.file.write(_RECORD.pack(time.perf_counter() - self.start, type_def.hash if type_def else 0, len(payload)))
+        self.file.write(payload)
+
+    def close(self):
+        self.file.close()
+
+
+def open_capture(path):
+    # context manager yielding a CaptureWriter, or None when path is None
+    return CaptureWriter(path) if path else nullcontext()
+
+
+def capture_path(config):
+    # a new capture file in the directory configured as engine_capture_dir, None if it's not configured
+    directory = config.get('engine_capture_dir') if config else None
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, datetime.now().strftime('capture-%Y%m%d-%H%M%S-%f.fcc'))
+
+
+def read_capture(path):
+    # yields the (timestamp, type hash, payload) records of a capture file
+    with open(path, 'rb') as capture_file:
+        data = memoryview(capture_file.read())
+    if data[:len(_MAGIC)] != _MAGIC:
+        raise ValueError('%s is not a capture file' % path)
+    offset = len(_MAGIC)
+    while offset < len(data):
+        timestamp, type_hash, length = _RECORD.unpack_from(data, offset)
+        offset += _RECORD.size
+        yield timestamp, type_hash, data[offset:offset + length]
+        offset += length
+
+
+def replay(path, address, speed=1.0, stop=None):
+    # plays a capture back as the engine would: connects to address, waits for the Slice, sends the recorded frames
+    # at `speed` times their recorded pace, or as fast as possible when speed is None, and closes the connection
+    from .curaengine import FrameParser, _SIGNATURE, _CLOSE_SOCKET
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        engine_socket = socket.create_connection((host, int(port)))
+    else:
+        engine_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        engine_socket.connect(address)
+    with closing(engine_socket):
+        parser = FrameParser()
+        received = []
+        while not received:  # waits for the Slice
+            frames = parser.receive(engine_socket)
+            if frames is None:
+                return
+            received = [type_def for type_def, _ in frames if type_def]
+        start = time.perf_counter()
+        for timestamp, type_hash, payload in read_capture(path):
+            if stop is not None and stop.is_set():
+                return
+            if speed:
+                delay = timestamp / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            if type_hash:
+                engine_socket.sendall(struct.pack('!III', _SIGNATURE, len(payload), type_hash))
+                engine_socket.sendall(payload)
+            else:
+                engine_socket.sendall(struct.pack('>I', 0))
+        engine_socket.sendall(struct.pack('>I', _CLOSE_SOCKET))
+
+
+class ReplayEngine:
+    # stands in for curaengine.spawn_engine(): run_engine(..., launcher=ReplayEngine(path)) gets its frames from the
+    # capture file instead of a CuraEngine process
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+
+    def __call__(self, config, address, log):
+        return ReplayProcess(self.path, address, self.speed)
+
+
+class ReplayProcess(threading.Thread):
+    # the part of the Popen interface used on the engine process, for a replay thread
+    pid = None
+
+    def __init__(self, path, address, speed):
+        super().__init__(daemon=True)
+        self.stop = threading.Event()
+        self.returncode = None
+        self.path, self.address, self.speed = path, address, speed
+        self.start()
+
+    def run(self):
+        try:
+            replay(self.path, self.address, self.speed, self.stop)
+            self.returncode = 0
+        except OSError:
+            self.returncode = 1
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        self.stop.set()
+
+    kill = terminate
+
+    def wait(self, timeout=None):
+        self.join(timeout)
+        return self.returncode
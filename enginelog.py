@@ -0,0 +1,114 @@
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from uuid import uuid4
+
+from .lib.appdirs import user_log_dir
+
+engine_log_file = os.path.join(user_log_dir('FusedCura', 'nraynaud'), 'engine.log')
+os.makedirs(os.path.dirname(engine_log_file), exist_ok=True)
+
+MAX_BYTES = 2 * 1024 * 1024  # size of engine.log before it's rotated
+BACKUP_COUNT = 3  # rotated files kept, engine.log.1 to engine.log.3
+OUTPUT_CAP = 256 * 1024  # bytes of engine output kept per job
+
+_logger = logging.getLogger('FusedCura.engine')
+_logger.setLevel(logging.INFO)
+_logger.propagate = False
+_lock = threading.Lock()
+_handler = None
+_listener = None
+
+
+def start_logging():
+    # the records are written by a background thread, logging from the slicing threads never waits for the disk
+    global _handler, _listener
+    with _lock:
+        if _listener:
+            return
+        _handler = RotatingFileHandler(engine_log_file, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT,
+                                       encoding='utf-8', delay=True)
+        _handler.setFormatter(logging.Formatter('%(asctime)s [%(job)s] %(message)s'))
+        records = queue.SimpleQueue()
+        _listener = QueueListener(records, _handler)
+        _listener.start()
+        _logger.addHandler(QueueHandler(records))
+
+
+def stop_logging():
+    # writes the pending records and closes the log file
+    global _handler, _listener
+    with _lock:
+        if not _listener:
+            return
+        _listener.stop()
+        for handler in list(_logger.handlers):
+            _logger.removeHandler(handler)
+        _handler.close()
+        _handler = _listener = None
+
+
+def clear_logs():
+    with _lock:
+        if _handler:
+            _handler.acquire()
+            try:
+                if _handler.stream:
+                    _handler.stream.seek(0)
+                    _handler.stream.truncate()
+            finally:
+                _handler.release()
+        else:
+            open(engine_log_file, 'w').close()
+    for index in range(1, BACKUP_COUNT + 1):
+        try:
+            os.remove('%s.%d' % (engine_log_file, index))
+        except OSError:
+            pass
+
+
+class EngineLog:
+    # The log of an engine process, in a section per job. The output of the engine is kept up to output_cap bytes
+    # per job, the rest is read and dropped so that the engine never waits on a full pipe.
+
+    def __init__(self, output_cap=OUTPUT_CAP):
+        start_logging()
+        self.output_cap = output_cap
+        self.job = '-'
+        self._output_size = 0
+
+    def start_job(self):
+        self.job = uuid4().hex[:8]
+        self._output_size = 0
+        self.info('--- job started')
+        return self.job
+
+    def info(self, message, *args):
+        _logger.info(message, *args, extra={'job': self.job})
+
+    def pump(self, stream):
+        # logs the lines of a binary stream, like the engine output pipe, from a background thread until its end
+        def read():
+            with stream:
+                for line in iter(stream.readline, b''):
+                    self.output(line)
+
+        threading.Thread(target=read, daemon=True).start()
+
+    async def pump_async(self, reader):
+        # logs the lines of an asyncio.StreamReader until its end
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            self.output(line)
+
+    def output(self, line):
+        size = self._output_size
+        self._output_size += len(line)
+        if self._output_size <= self.output_cap:
+            self.info('engine: %s', line.decode(errors='replace').rstrip())
+        elif size <= self.output_cap:
+            self.info('engine output of this job truncated after %d bytes', self.output_cap)
@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .curaengine import engine_log_file
+
+metrics_file = os.path.join(os.path.dirname(engine_log_file), 'engine_metrics.json')
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket is unbounded
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+KEEP_ALIVE = 'keep-alive'
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def to_dict(self):
+        return {'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'], self.counts)),
+                'count': self.count, 'sum': self.sum}
+
+
+class TypeMetrics:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.decode = Histogram()
+        self.handle = Histogram()
+
+    def to_dict(self):
+        return {'frames': self.frames, 'bytes': self.bytes, 'decode_seconds': self.decode.to_dict(),
+                'handle_seconds': self.handle.to_dict()}
+
+
+class EngineMetrics:
+    # Per message type frame counts, byte totals and decode and handler latency histograms, fed by the thread
+    # reading the engine socket (received()) and by the consumer (decoded(), handled()).
+
+    def __init__(self):
+        self.sessions = 0
+        self._types = {}
+        self._lock = threading.Lock()
+
+    def _type(self, type_def):
+        symbol = type_def.symbol if type_def else KEEP_ALIVE
+        metrics = self._types.get(symbol)
+        if metrics is None:
+            metrics = self._types[symbol] = TypeMetrics()
+        return metrics
+
+    def session(self):
+        with self._lock:
+            self.sessions += 1
+
+    def received(self, type_def, size):
+        with self._lock:
+            metrics = self._type(type_def)
+            metrics.frames += 1
+            metrics.bytes += size
+
+    def decoded(self, type_def, seconds):
+        with self._lock:
+            self._type(type_def).decode.observe(seconds)
+
+    def handled(self, type_def, seconds):
+        with self._lock:
+            self._type(type_def).handle.observe(seconds)
+
+    def to_dict(self):
+        with self._lock:
+            return {'sessions': self.sessions,
+                    'types': {symbol: metrics.to_dict() for symbol, metrics in sorted(self._types.items())}}
+
+    def dump(self, path=metrics_file):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def prometheus(self):
+        # the metrics in the Prometheus text exposition format
+        stats = self.to_dict()
+        lines = ['# TYPE fusedcura_engine_sessions_total counter',
+                 'fusedcura_engine_sessions_total %d' % stats['sessions']]
+        for name, key in [('frames', 'frames'), ('bytes', 'bytes')]:
+            lines.append('# TYPE fusedcura_engine_%s_total counter' % name)
+            lines.extend('fusedcura_engine_%s_total{type="%s"} %d' % (name, symbol, metrics[key])
+                         for symbol, metrics in stats['types'].items())
+        for name in ['decode_seconds', 'handle_seconds']:
+            lines.append('# TYPE fusedcura_engine_%s histogram' % name)
+            for symbol, metrics in stats['types'].items():
+                histogram = metrics[name]
+                cumulated = 0
+                for bound, count in histogram['buckets'].items():
+                    cumulated += count
+                    lines.append('fusedcura_engine_%s_bucket{type="%s",le="%s"} %d' % (name, symbol, bound, cumulated))
+                lines.append('fusedcura_engine_%s_sum{type="%s"} %r' % (name, symbol, histogram['sum']))
+                lines.append('fusedcura_engine_%s_count{type="%s"} %d' % (name, symbol, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    # serves the metrics to Prometheus on http://127.0.0.1:<port>/metrics from a background thread
+
+    def __init__(self, metrics, port):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,177 @@
+import threading
+import time
+import traceback
+
+from .curaengine import EngineHandle, FrameParser, kill_engine, send_chunks, slice_header, spawn_engine
+from .enginecapture import open_capture
+from .enginelog import EngineLog
+from .messages import Slice
+
+CONNECT_TIMEOUT = 30
+
+
+class EngineWorker(EngineHandle):
+    # A CuraEngine process spawned and connected ahead of time. It slices the jobs one after the other on the same
+    # connection, a job ends with SlicingFinished.
+    # started_handler gets the worker before the engine is spawned, so that it can be terminated while it starts,
+    # launcher is the one of run_engine().
+
+    def __init__(self, config, started_handler=None, launcher=spawn_engine):
+        super().__init__(None, log=EngineLog())
+        self.executable = config['curaengine']
+        self.jobs = 0
+        self.socket = None
+        self.parser = FrameParser()
+        if started_handler:
+            started_handler(self)
+        try:
+            self.log.info('warm engine configuration %s', dict(config))
+            self.socket = self.connect(config, launcher, CONNECT_TIMEOUT)
+        except BaseException:
+            self.close()
+            raise
+
+    def run(self, slice_message: Slice, event_handler, keep_alive_handler=None, capture_file=None, metrics=None):
+        # same contract as run_engine(), returns after SlicingFinished or when the engine closes the connection
+        with open_capture(capture_file) as capture:
+            self._run(slice_message, event_handler, keep_alive_handler, capture, metrics)
+
+    def _run(self, slice_message, event_handler, keep_alive_handler, capture, metrics):
+        if metrics:
+            metrics.session()
+        self.jobs += 1
+        self.log.start_job()
+        self.log.info('job %d of engine %s', self.jobs, self.process.pid)
+        encoded_chunks = Slice.dump_chunks(slice_message)
+        send_chunks(self.socket, [slice_header(encoded_chunks)] + encoded_chunks)
+        if capture:
+            capture.start = time.perf_counter()
+        while not self.parser.done:
+            frames = self.parser.receive(self.socket)
+            if frames is None:
+                self.parser.done = True
+                break
+            for type_def, payload in frames:
+                if capture:
+                    capture.record(type_def, payload)
+                if metrics:
+                    metrics.received(type_def, len(payload))
+                if type_def is None:
+                    if keep_alive_handler:
+                        keep_alive_handler()
+                    continue
+                event_handler(payload, type_def)
+                if type_def.symbol == 'cura.proto.SlicingFinished':
+                    return
+
+    def healthy(self):
+        # the process is alive and nothing but keep-alives arrived since the last job
+        if self.terminated or self.process.poll() is not None or self.parser.done:
+            return False
+        self.socket.setblocking(False)
+        try:
+            frames = self.parser.receive(self.socket)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            self.socket.setblocking(True)
+        return frames is not None and not self.parser.done and all(type_def is None for type_def, _ in frames)
+
+    def close(self):
+        super().close()
+        if self.process:
+            kill_engine(self.process)
+            self.log.info('engine exited %s', self.process.wait())
+
+
+class EnginePool:
+    # Keeps `size` idle engines warm so a job doesn't wait for the engine start and the definitions loading.
+    # An engine is recycled after `max_jobs` jobs, when it fails its health check or when the configured engine
+    # changed. config and launcher are the ones of run_engine(), the configuration is read for each engine by default.
+
+    def __init__(self, size=1, max_jobs=20, config=None, launcher=spawn_engine):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.config = config
+        self.launcher = launcher
+        self._idle = []
+        self._spawning = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        # spawns the missing idle engines in the background
+        threading.Thread(target=self._replenish, daemon=True).start()
+
+    def _configuration(self):
+        if self.config is not None:
+            return self.config
+        from .settings import read_configuration
+        return read_configuration()
+
+    def _replenish(self):
+        while True:
+            with self._lock:
+                if self._closed or len(self._idle) + self._spawning >= self.size:
+                    return
+                self._spawning += 1
+            try:
+                worker = EngineWorker(self._configuration(), launcher=self.launcher)
+            except Exception:
+                traceback.print_exc()
+                with self._lock:
+                    self._spawning -= 1
+                return
+            with self._lock:
+                self._spawning -= 1
+                if not self._closed:
+                    self._idle.append(worker)
+                    continue
+            worker.close()
+            return
+
+    def acquire(self, started_handler=None):
+        # started_handler gets the worker as soon as it can be terminated, before a cold start
+        config = self._configuration()
+        while True:
+            with self._lock:
+                worker = self._idle.pop() if self._idle else None
+            if worker is None:
+                return EngineWorker(config, started_handler, self.launcher)
+            if worker.executable == config['curaengine'] and worker.healthy():
+                if started_handler:
+                    started_handler(worker)
+                return worker
+            worker.close()
+
+    def release(self, worker):
+        if worker.jobs < self.max_jobs and worker.healthy():
+            with self._lock:
+                if not self._closed and len(self._idle) < self.size:
+                    self._idle.append(worker)
+                    return
+        worker.close()
+
+    def run(self, slice_message: Slice, event_handler, child_started_handler=None, keep_alive_handler=None,
+            capture_file=None, metrics=None):
+        # drop-in replacement for run_engine() running the job on a warm engine
+        worker = self.acquire(child_started_handler)
+        self.start()
+        if worker.terminated:
+            worker.close()
+            return
+        try:
+            worker.run(slice_message, event_handler, keep_alive_handler, capture_file, metrics)
+        except BaseException:
+            worker.close()
+            raise
+        self.release(worker)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.close()
@@ -0,0 +1,111 @@
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+from .messages import LayerOptimized
+from .toolpath import BUFFER_FORMATS, ToolpathLayer, toolpath_layer
+
+# run by exec() in each worker before it unpickles _decode_into(): the workers find this package by its name only when
+# its parent directory is on sys.path, which is not the case inside Fusion 360, so it's registered from its directory
+_WORKER_SETUP = '''
+import sys, types
+if %(name)r not in sys.modules:
+    package = types.ModuleType(%(name)r)
+    package.__path__ = [%(path)r]
+    sys.modules[%(name)r] = package
+'''
+
+
+def _capacity(payload_size):
+    # a point takes at least 9 bytes of payload (2 floats and its line type), in the output it's in at most 2 strips
+    # (12 bytes each) and starts at most a strip (4 bytes for its offset, 1 for its type and 1 for its extruder)
+    return _align(payload_size) + payload_size * 30 // 9 + 64
+
+
+def _align(offset):
+    return (offset + 3) & ~3
+
+
+def _decode_into(name, payload_size, fields):
+    # runs in a worker: decodes the fields of the LayerOptimized payload at the start of the block and writes the
+    # buffers of its ToolpathLayer after it, returns (id, height, thickness, [(offset, size) of each buffer])
+    block = shared_memory.SharedMemory(name)  # registered with the resource tracker of the parent, which unlinks it
+    try:
+        layer = LayerOptimized.loads(block.buf[:payload_size], fields)
+        toolpath = toolpath_layer(layer)
+        del layer  # its fields are views of the block
+        offset = _align(payload_size)
+        buffers = []
+        for buffer in toolpath.buffers():
+            block.buf[offset:offset + buffer.nbytes] = buffer.cast('B')
+            buffers.append((offset, buffer.nbytes))
+            offset = _align(offset + buffer.nbytes)
+        return toolpath.id, toolpath.height, toolpath.thickness, buffers
+    finally:
+        block.close()
+
+
+class SharedLayer:
+    # A layer decoded by a worker, layer is a ToolpathLayer with views of the shared block.
+
+    def __init__(self, block, layer_id, height, thickness, buffers):
+        view = block.buf
+        # assigned before the block so that the views are dropped first when the layer is freed
+        self.layer = ToolpathLayer(layer_id, height, thickness,
+                                   *(view[offset:offset + size].cast(format)
+                                     for (offset, size), format in zip(buffers, BUFFER_FORMATS)))
+        self.block = block
+
+    def release(self):
+        self.layer.release()
+        try:
+            self.block.close()
+        except BufferError:
+            pass  # a view is still in use, the mapping goes with it
+
+
+class LayerDecoder:
+    # Decodes the LayerOptimized messages in worker processes. The payload is handed to the worker and the strips
+    # returned in a shared memory block, only their offsets are pickled.
+    # Inside Fusion 360, executable has to be set to a Python interpreter since sys.executable is Fusion itself.
+
+    def __init__(self, processes, executable=None):
+        context = multiprocessing.get_context('spawn')
+        if executable:
+            context.set_executable(executable)
+        setup = _WORKER_SETUP % {'name': __package__, 'path': os.path.dirname(os.path.abspath(__file__))}
+        self.executor = ProcessPoolExecutor(processes, mp_context=context, initializer=exec, initargs=(setup,))
+
+    def submit(self, payload, fields=None):
+        # returns a Future of the SharedLayer, fields restricts the decoded fields like in MessageType.decode()
+        block = shared_memory.SharedMemory(create=True, size=_capacity(len(payload)))
+        block.buf[:len(payload)] = payload
+        result = Future()
+
+        def done(future):
+            if os.name != 'nt':
+                block.unlink()  # the mapping stays valid, it's freed with the last reference
+            try:
+                result.set_result(SharedLayer(block, *future.result()))
+            except BaseException as error:
+                block.close()
+                result.set_exception(error)
+
+        self.executor.submit(_decode_into, block.name, len(payload), fields).add_done_callback(done)
+        return result
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def make_layer_decoder(config):
+    # the LayerDecoder configured with decode_processes (and decode_python), None when it's not configured
+    processes = int(config.get('decode_processes', 0) or 0) if config else 0
+    if processes <= 0 or shared_memory is None:
+        return None
+    return LayerDecoder(processes, config.get('decode_python'))
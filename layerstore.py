@@ -0,0 +1,178 @@
+import glob
+import mmap
+import os
+import tempfile
+import threading
+
+from .lib.appdirs import user_cache_dir
+from .toolpath import BUFFER_FORMATS, ToolpathLayer, toolpath_layer
+
+spill_directory = os.path.join(user_cache_dir('FusedCura', 'nraynaud'), 'layers')
+
+
+class LayerSpill:
+    # The completed layers of a slice appended to a file and read back through memory maps, so that they are paged
+    # in by the OS from its page cache when they are displayed, instead of staying in the memory of the add-in.
+    # index is {layer id: (height, thickness, [(offset, size) of each buffer])}.
+
+    def __init__(self, directory=spill_directory):
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, 'layers-*.bin')):
+            try:
+                os.remove(path)  # left by a crash, the files in use are already unlinked or locked on Windows
+            except OSError:
+                pass
+        descriptor, self.path = tempfile.mkstemp('.bin', 'layers-', directory)
+        self.file = open(descriptor, 'w+b')
+        if os.name != 'nt':
+            os.remove(self.path)  # the file is freed when it's closed, even after a crash
+        self.index = {}
+        self.size = 0
+        self._maps = []
+        self._lock = threading.Lock()
+
+    def write(self, layer):
+        # False when a layer with this id was already written, the layer is left alone
+        with self._lock:
+            if layer.id in self.index:
+                return False
+            buffers = []
+            for buffer in layer.buffers():
+                padding = -self.size % 4
+                self.file.write(bytes(padding))
+                self.file.write(buffer)
+                buffers.append((self.size + padding, buffer.nbytes))
+                self.size += padding + buffer.nbytes
+            self.file.flush()
+            self.index[layer.id] = (layer.height, layer.thickness, buffers)
+            return True
+
+    def ids(self):
+        with self._lock:
+            return list(self.index)
+
+    def read(self, layer_id):
+        # a ToolpathLayer with views of the file mapping, KeyError when the layer was not spilled
+        with self._lock:
+            height, thickness, buffers = self.index[layer_id]
+            offset, size = buffers[-1]
+            if not self._maps or len(self._maps[-1]) < offset + size:
+                # the previous mappings stay open for the views still using them
+                self._maps.append(mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ))
+            view = memoryview(self._maps[-1])
+        return ToolpathLayer(layer_id, height, thickness,
+                             *(view[offset:offset + size].cast(format)
+                               for (offset, size), format in zip(buffers, BUFFER_FORMATS)))
+
+    def close(self):
+        with self._lock:
+            maps, self._maps = self._maps, []
+            self.index = {}
+        for mapping in maps:
+            try:
+                mapping.close()
+            except BufferError:
+                pass  # a view is still in use, the mapping goes with it
+        self.file.close()
+        if os.name == 'nt':
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass  # still mapped, removed by the next spill
+
+
+def make_layer_spill(config):
+    # the LayerSpill when layer_spill is set in the configuration, None otherwise
+    enabled = str(config.get('layer_spill', '') if config else '').lower() not in ('', '0', 'false', 'no')
+    return LayerSpill() if enabled else None
+
+
+class LayerStore:
+    # The toolpath layers of a slice by layer id, written by the engine threads and read by the UI thread.
+    # A layer is added either as a ToolpathLayer or as its LayerOptimized message, converted on its first access.
+    # With a LayerSpill, the layers are written to it as they are added and only read back when they are accessed.
+
+    def __init__(self, spill=None):
+        self.spill = spill
+        self._layers = {}
+        self._messages = {}
+        self._releases = []
+        self._lods = {}  # {layer id: ToolpathLayer.lods} of the spilled layers, read again on each access
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def add(self, layer, release=None):
+        # release is called when the store is closed, for the layers whose buffers are not owned by Python, or right
+        # away when the layer is spilled or added after close(). A layer id the store already holds is ignored, with
+        # its layer.
+        with self._lock:
+            if not self._closed:
+                if self.spill:
+                    if not self.spill.write(layer):  # under the lock, so that close() waits for the end of the write
+                        return
+                elif layer.id in self._layers or layer.id in self._messages:
+                    return
+                else:
+                    self._layers[layer.id] = layer
+                    if release:
+                        self._releases.append(release)
+                    return
+        if release:
+            release()
+
+    def add_message(self, message):
+        # dropped after close()
+        if self.spill:
+            if not self._closed and message.id not in self.spill.ids():
+                self.add(toolpath_layer(message))
+            return
+        with self._lock:
+            if not self._closed and message.id not in self._layers:
+                self._messages.setdefault(message.id, message)
+
+    def ids(self):
+        spilled = self.spill.ids() if self.spill else ()
+        with self._lock:
+            return sorted({*self._layers, *self._messages, *spilled})
+
+    def layer(self, layer_id):
+        # the ToolpathLayer, KeyError when there is no such layer
+        if self.spill:
+            layer = self.spill.read(layer_id)
+            with self._lock:
+                layer.lods = self._lods.setdefault(layer_id, {})
+            return layer
+        with self._lock:
+            layer = self._layers.get(layer_id)
+            message = self._messages[layer_id] if layer is None else None
+        if layer is None:
+            layer = toolpath_layer(message)
+            with self._lock:
+                self._messages.pop(layer_id, None)
+                self._layers[layer_id] = layer
+        return layer
+
+    def query(self, first, end, line_types=None):
+        # the ToolpathLayers of ids in range(first, end) with strips of one of line_types, all of them by default,
+        # only these layers are read from the spill
+        for layer_id in self.ids():
+            if first <= layer_id < end:
+                layer = self.layer(layer_id)
+                if line_types is None or not line_types.isdisjoint(layer.line_types()):
+                    yield layer
+
+    def nbytes(self):
+        # the size of the layers in memory, the spilled ones are not counted, nor the levels of detail
+        with self._lock:
+            return sum(layer.nbytes() for layer in self._layers.values())
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            releases, self._releases = self._releases, []
+            self._messages = {}
+            self._lods = {}
+        for release in releases:
+            release()
+        if self.spill:
+            self.spill.close()
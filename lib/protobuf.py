@@ -8,9 +8,93 @@ eigenein (c) 2011-2016
 '''
 
 from io import BytesIO
+import array
 import struct
+import sys
 import marshal
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Varints. ---------------------------------------------------------------------
+# These work on buffers directly, every key, length and varint goes through them.
+
+_single_byte_uvarints = [bytes((value,)) for value in range(0x80)]
+
+
+def uvarint_size(value):
+    '''
+    Returns the number of bytes of the unsigned varint encoding of value.
+    '''
+    size = 1
+    while value > 0x7F:
+        value >>= 7
+        size += 1
+    return size
+
+
+def encode_uvarint_into(buffer, offset, value):
+    '''
+    Encodes an unsigned varint into a preallocated bytearray at offset and
+    returns the offset just past it.
+    '''
+    while value > 0x7F:
+        buffer[offset] = (value & 0x7F) | 0x80
+        value >>= 7
+        offset += 1
+    buffer[offset] = value
+    return offset + 1
+
+
+def encode_uvarint(value):
+    '''
+    Returns the unsigned varint encoding of value, raises ValueError for a
+    negative value.
+    '''
+    if value < 0x80:
+        if value < 0:
+            raise ValueError('Negative value %d can\'t be encoded as an unsigned varint.' % value)
+        return _single_byte_uvarints[value]
+    buffer = bytearray(uvarint_size(value))
+    encode_uvarint_into(buffer, 0, value)
+    return bytes(buffer)
+
+
+def decode_uvarint(buffer, offset):
+    '''
+    Decodes an unsigned varint at offset of a bytes-like buffer and returns the
+    value and the offset just past it.
+    '''
+    quantum = buffer[offset]
+    if quantum < 0x80:
+        return quantum, offset + 1
+    value, shift = quantum & 0x7F, 7
+    while True:
+        offset += 1
+        quantum = buffer[offset]
+        value |= (quantum & 0x7F) << shift
+        if quantum < 0x80:
+            return value, offset + 1
+        shift += 7
+
+
+def read_uvarint(fp):
+    '''
+    Reads an unsigned varint from a read-like object and returns its value,
+    decoded by decode_uvarint(). Raises EOFError when the stream ends first.
+    '''
+    buffer = bytearray()
+    while True:
+        quantum = fp.read(1)
+        if not quantum:
+            raise EOFError()
+        buffer += quantum
+        if quantum[0] < 0x80:
+            return decode_uvarint(buffer, 0)[0]
+
 
 # Types. -----------------------------------------------------------------------
 
@@ -31,6 +115,28 @@ class Type:
         '''
         raise TypeError('Don\'t call this directly.')
 
+    def decode(self, view, offset):
+        '''
+        Decodes its value from a memoryview at offset and returns the value
+        and the offset just past it.
+        '''
+        raise TypeError('Don\'t call this directly.')
+
+    def encoded_size(self, value, writer):
+        '''
+        Returns the size of its encoded value, first pass of ChunkWriter.
+        Computed values that encode() will need are appended to writer.plan.
+        '''
+        encoded = self.dumps(value)
+        writer.plan.append(encoded)
+        return len(encoded)
+
+    def encode(self, value, writer):
+        '''
+        Writes its value to a ChunkWriter, second pass of ChunkWriter.
+        '''
+        writer.write(writer.next_planned())
+
     def dumps(self, value):
         '''
         Dumps its value to string and returns this string.
@@ -43,7 +149,7 @@ class Type:
         '''
         Loads its value from a string and returns a read value.
         '''
-        return self.load(BytesIO(s))
+        return self.decode(memoryview(s).cast('B'), 0)[0]
 
     def __hash__(self):
         '''
@@ -65,47 +171,70 @@ class UVarintType(Type):
     WIRE_TYPE = 0
 
     def dump(self, fp, value):
-        shifted_value = True
-        while shifted_value:
-            shifted_value = value >> 7
-            fp.write(((value & 0x7F) | (0x80 if shifted_value != 0 else 0x00)).to_bytes(1, byteorder='big'))
-            value = shifted_value
+        fp.write(encode_uvarint(value))
 
-    def load(self, fp):
-        value, shift, quantum = 0, 0, 0x80
-        while (quantum & 0x80) == 0x80:
-            quantum = int.from_bytes(fp.read(1), byteorder='big')
-            value, shift = value + ((quantum & 0x7F) << shift), shift + 7
-        return value
+    load = lambda self, fp: read_uvarint(fp)
+
+    def decode(self, view, offset):
+        return decode_uvarint(view, offset)
+
+    encoded_size = lambda self, value, writer: uvarint_size(value)
+
+    encode = lambda self, value, writer: writer.write_uvarint(value)
 
     default = lambda self: 0
 
 
+def _zigzag(value):
+    '''
+    Maps a signed value to the unsigned value of its ZigZag encoding.
+    '''
+    encoded_varint = abs(value) << 1
+    if value < 0:
+        encoded_varint -= 1
+    return encoded_varint
+
+
 class VarintType(UVarintType):
     '''
     Represents a signed Varint type. Implements ZigZag encoding.
     '''
 
     def dump(self, fp, value):
-        encoded_varint = abs(value) << 1
-        if value < 0:
-            encoded_varint -= 1
-        UVarintType.dump(self, fp, encoded_varint)
+        UVarintType.dump(self, fp, _zigzag(value))
 
     def load(self, fp):
-        encoded_varint = UVarintType.load(self, fp) + 1
+        encoded_varint = read_uvarint(fp) + 1
         div = encoded_varint >> 1
         return div if encoded_varint & 1 else -div
 
+    def decode(self, view, offset):
+        encoded_varint, offset = decode_uvarint(view, offset)
+        encoded_varint += 1
+        div = encoded_varint >> 1
+        return (div if encoded_varint & 1 else -div), offset
+
+    encoded_size = lambda self, value, writer: uvarint_size(_zigzag(value))
+
+    encode = lambda self, value, writer: writer.write_uvarint(_zigzag(value))
+
 
 class BoolType(UVarintType):
     '''
     Represents a boolean type. Encodes True as UVarint 1, and False as UVarint 0.
     '''
 
-    dump = lambda self, fp, value: fp.write('\x01' if value else '\x00')  # Similarly to UVarint.
+    dump = lambda self, fp, value: fp.write(b'\x01' if value else b'\x00')  # Similarly to UVarint.
+
+    load = lambda self, fp: read_uvarint(fp) != 0
+
+    def decode(self, view, offset):
+        value, offset = decode_uvarint(view, offset)
+        return value != 0, offset
+
+    encoded_size = lambda self, value, writer: 1
 
-    load = lambda self, fp: UVarintType.load(self, fp) != 0
+    encode = lambda self, value, writer: writer.write(b'\x01' if value else b'\x00')
 
     default = lambda self: False
 
@@ -118,11 +247,22 @@ class BytesType(Type):
     WIRE_TYPE = 2
 
     def dump(self, fp, value):
-        UVarint.dump(fp, len(value))
+        fp.write(encode_uvarint(len(value)))
         fp.write(value)
 
     def load(self, fp):
-        return fp.read(UVarint.load(fp))
+        return fp.read(read_uvarint(fp))
+
+    def decode(self, view, offset):
+        '''
+        Returns a slice of view, the value is not copied.
+        '''
+        length, offset = decode_uvarint(view, offset)
+        return view[offset:offset + length], offset + length
+
+    encoded_size = lambda self, value, writer: writer.bytes_size(len(value))
+
+    encode = lambda self, value, writer: writer.write_bytes(value)
 
     default = lambda self: b''
 
@@ -132,6 +272,17 @@ class UnicodeType(BytesType):
 
     load = lambda self, fp: BytesType.load(self, fp).decode("utf-8", "replace")
 
+    def decode(self, view, offset):
+        value, offset = BytesType.decode(self, view, offset)
+        return str(value, "utf-8", "replace"), offset
+
+    def encoded_size(self, value, writer):
+        encoded = value.encode('utf-8')
+        writer.plan.append(encoded)
+        return writer.bytes_size(len(encoded))
+
+    encode = lambda self, value, writer: writer.write_bytes(writer.next_planned())
+
     default = lambda self: ''
 
 
@@ -145,6 +296,14 @@ class FixedLengthType(Type):
 
     load = lambda self, fp: fp.read(self.length())
 
+    def decode(self, view, offset):
+        end = offset + self.length()
+        return bytes(view[offset:end]), end
+
+    encoded_size = lambda self, value, writer: self.length()
+
+    encode = lambda self, value, writer: writer.write(value)
+
     default = lambda self: bytearray(self.length())
 
 
@@ -177,6 +336,11 @@ class Fixed64SubType(Fixed64Type):
 
     load = lambda self, fp: struct.unpack(self.format, Fixed64Type.load(self, fp))[0]
 
+    def decode(self, view, offset):
+        return struct.unpack_from(self.format, view, offset)[0], offset + 8
+
+    encode = lambda self, value, writer: writer.pack(self.format, value)
+
     default = lambda self: self.loads(FixedLengthType.default(self))
 
 
@@ -213,6 +377,11 @@ class Fixed32SubType(Fixed32Type):
 
     load = lambda self, fp: struct.unpack(self.format, Fixed32Type.load(self, fp))[0]
 
+    def decode(self, view, offset):
+        return struct.unpack_from(self.format, view, offset)[0], offset + 4
+
+    encode = lambda self, value, writer: writer.pack(self.format, value)
+
     default = lambda self: self.loads(FixedLengthType.default(self))
 
 class UInt32Type(Fixed32SubType):
@@ -308,10 +477,302 @@ def _unpack_key(key):
     return key >> 3, key & 7
 
 
+_absent = object()  # Returned by getattr() for the fields without value.
+
 # This used to correctly determine the length of unknown tags when loading a message.
 _wire_type_to_type_instance = {0: Varint, 1: Fixed64, 2: Bytes, 5: Fixed32}
 
 
+# Compiled field codecs. -------------------------------------------------------
+# MessageType resolves the per-field dispatch once and builds these closures so
+# that dumping and loading a message does no flag or name lookup per field.
+
+class ChunkWriter:
+    '''
+    Encodes a message in two passes into a list of chunks. The first pass
+    computes the sizes, so that every length prefix is known when the second
+    pass appends the fields to a buffer. Large bytes values are not copied,
+    the chunk list references them between two buffers.
+    '''
+
+    REFERENCE_SIZE = 4096  # Bytes values at least this long are referenced instead of copied.
+
+    def __init__(self):
+        self.plan = []  # Values computed while sizing (sub-message sizes, encoded strings...) in encoding order.
+        self.next_planned = None
+        self.buffer = bytearray()
+        self.__chunks = []
+
+    def bytes_size(self, length):
+        '''
+        Returns the encoded size of a length-delimited value of length bytes.
+        '''
+        return uvarint_size(length) + length
+
+    def start_encoding(self):
+        '''
+        Ends the sizing pass.
+        '''
+        self.next_planned = iter(self.plan).__next__
+
+    def write(self, data):
+        self.buffer += data
+
+    def write_uvarint(self, value):
+        self.buffer += encode_uvarint(value)
+
+    def pack(self, format, value):
+        self.buffer += struct.pack(format, value)
+
+    def write_bytes(self, data):
+        '''
+        Writes a length-delimited value, referencing it when it is large.
+        '''
+        self.buffer += encode_uvarint(len(data))
+        if len(data) >= self.REFERENCE_SIZE:
+            self.__chunks.extend((self.buffer, data))
+            self.buffer = bytearray()
+        else:
+            self.buffer += data
+
+    def chunks(self):
+        '''
+        Ends the encoding pass and returns the chunks.
+        '''
+        if self.buffer:
+            self.__chunks.append(self.buffer)
+        return self.__chunks
+
+
+def _single_field(key, field_type):
+    '''
+    Returns the sizer and the emitter of a single value field.
+    '''
+    encoded_size, encode, key_size = field_type.encoded_size, field_type.encode, len(key)
+
+    def size(value, writer):
+        return key_size + encoded_size(value, writer)
+
+    def emit(value, writer):
+        writer.write(key)
+        encode(value, writer)
+
+    return size, emit
+
+
+def _repeated_field(key, field_type):
+    '''
+    Returns the sizer and the emitter of a repeated field written value by value.
+    '''
+    encoded_size, encode, key_size = field_type.encoded_size, field_type.encode, len(key)
+
+    def size(values, writer):
+        return sum(key_size + encoded_size(single_value, writer) for single_value in values)
+
+    def emit(values, writer):
+        for single_value in values:
+            writer.write(key)
+            encode(single_value, writer)
+
+    return size, emit
+
+
+def _packed_field(key, payload):
+    '''
+    Returns the sizer and the emitter of a packed repeated field, payload
+    returns the bytes of the packed values.
+    '''
+    key_size = len(key)
+
+    def size(values, writer):
+        packed = payload(values)
+        writer.plan.append(packed)
+        return key_size + writer.bytes_size(len(packed))
+
+    def emit(values, writer):
+        writer.write(key)
+        writer.write_bytes(writer.next_planned())
+
+    return size, emit
+
+
+def _packed_payload(field_type):
+    '''
+    Returns a function packing values one by one.
+    '''
+    dump = field_type.dump
+
+    def payload(values):
+        internal_fp = BytesIO()
+        for single_value in values:
+            dump(internal_fp, single_value)
+        return internal_fp.getvalue()
+
+    return payload
+
+
+def _packed_array_payload(field_type, typecode, byteswap):
+    '''
+    Returns a function packing fixed-size numbers in one step from an array, a
+    NumPy array or any iterable.
+    '''
+    dtype = numpy.dtype(field_type.format) if numpy is not None else None
+
+    def payload(values):
+        if dtype is not None and isinstance(values, numpy.ndarray):
+            return values.astype(dtype, copy=False).tobytes()
+        if isinstance(values, array.array) and values.typecode == typecode and not byteswap:
+            return values.tobytes()
+        values = array.array(typecode, values)
+        if byteswap:
+            values.byteswap()
+        return values.tobytes()
+
+    return payload
+
+
+def _single_reader(name, field_type):
+    '''
+    Returns a reader decoding a single value field into a message.
+    '''
+    decode = field_type.decode
+
+    def read(view, offset, message):
+        value, offset = decode(view, offset)
+        setattr(message, name, value)
+        return offset
+
+    return read
+
+
+def _packed_reader(name, field_type):
+    '''
+    Returns a reader decoding a packed repeated field into a message.
+    '''
+    decode = field_type.decode
+
+    def read(view, offset, message):
+        length, offset = decode_uvarint(view, offset)
+        end = offset + length
+        packed_view = view[offset:end]  # Bound the values with the field length.
+        repeated_value = list()
+        setattr(message, name, repeated_value)
+        position = 0
+        while position < len(packed_view):
+            value, position = decode(packed_view, position)
+            repeated_value.append(value)
+        return end
+
+    return read
+
+
+def _packed_array_reader(name, field_type, typecode, byteswap):
+    '''
+    Returns a reader decoding a packed repeated field of fixed-size numbers in
+    one step, into a NumPy array over the received buffer when NumPy is
+    available and into an array otherwise.
+    '''
+    dtype = numpy.dtype(field_type.format) if numpy is not None else None
+    itemsize = struct.calcsize(field_type.format)
+
+    def read(view, offset, message):
+        length, offset = decode_uvarint(view, offset)
+        end = offset + length
+        packed_view = view[offset:end - length % itemsize]  # Bound the values with the field length.
+        if dtype is not None:
+            values = numpy.frombuffer(packed_view, dtype)
+        else:
+            values = array.array(typecode)
+            values.frombytes(packed_view)
+            if byteswap:
+                values.byteswap()
+        setattr(message, name, values)
+        return end
+
+    return read
+
+
+def _repeated_reader(name, field_type):
+    '''
+    Returns a reader appending one value of a repeated field to a message.
+    '''
+    decode = field_type.decode
+
+    def read(view, offset, message):
+        value, offset = decode(view, offset)
+        repeated_value = getattr(message, name, None)
+        if repeated_value is None:
+            setattr(message, name, [value])
+        else:
+            repeated_value.append(value)
+        return offset
+
+    return read
+
+
+def _array_format(field_type):
+    '''
+    Returns (typecode, byteswap) of the array.array holding packed values of
+    field_type, or None when they are not fixed-size numbers.
+    '''
+    format = getattr(field_type, 'format', None)
+    if format is None or format[-1] not in 'fdiIqQ':
+        return None
+    typecode = format[-1]
+    if array.array(typecode).itemsize != struct.calcsize(format):
+        return None
+    byte_order = {'>': 'big', '!': 'big', '<': 'little'}.get(format[0], sys.byteorder)
+    return typecode, byte_order != sys.byteorder
+
+
+def _empty_packed_array(field_type):
+    '''
+    Returns a function creating the value of an absent packed field of fixed-size numbers.
+    '''
+    if numpy is not None:
+        return lambda: numpy.empty(0, numpy.dtype(field_type.format))
+    return lambda: array.array(_array_format(field_type)[0])
+
+
+def _skip_value(view, offset, wire_type):
+    '''
+    Returns the offset just past the value at offset, without decoding it.
+    '''
+    if wire_type == 2:
+        length, offset = decode_uvarint(view, offset)
+        return offset + length
+    if wire_type == 0:
+        return decode_uvarint(view, offset)[1]
+    return offset + _wire_type_to_type_instance[wire_type].length()
+
+
+def _check_wire_type(reader_info, tag, wire_type):
+    '''
+    Returns the reader of a field after checking the received wire type against the declared one.
+    '''
+    expected_wire_type, reader, packed = reader_info
+    if wire_type != expected_wire_type:
+        if packed:
+            raise TypeError('Tag %s has wiretype %s while the field is packed repeated.' % (tag, wire_type))
+        raise TypeError('The received value with the tag %s has incorrect wiretype: %s instead of %s expected.' %
+                        (tag, wire_type, expected_wire_type))
+    return reader
+
+
+def _deferred_field(message_type, name, reader, view, offsets):
+    '''
+    Returns a function decoding, when called, the field values found at offsets in view.
+    '''
+
+    def decode():
+        scratch = message_type()
+        for offset in offsets:
+            reader(view, offset, scratch)
+        return getattr(scratch, name)
+
+    return decode
+
+
 class MessageType(Type):
     '''
     Represents a message type.
@@ -324,6 +785,10 @@ class MessageType(Type):
         self.__tags_to_types = dict()  # Maps a tag to a type instance.
         self.__tags_to_names = dict()  # Maps a tag to a given field name.
         self.__flags = dict()  # Maps a tag to flags.
+        self.__encoder = None  # Compiled on the first dump.
+        self.__decoders = dict()  # Maps a field mask (None for all the fields) to its compiled decoding.
+        self.__message_class = None  # Generated on the first instantiation.
+        self.__lazy_message_class = None  # Generated on the first lazy load.
 
     def __hash__(self):
         _hash = 17
@@ -347,6 +812,7 @@ class MessageType(Type):
         self.__tags_to_names[tag] = name
         self.__tags_to_types[tag] = field_type
         self.__flags[tag] = flags
+        self.__invalidate()
         return self  # Allow add_field chaining.
 
     def remove_field(self, tag):
@@ -358,12 +824,42 @@ class MessageType(Type):
             del self.__tags_to_names[tag]
         if tag in self.__tags_to_types:
             del self.__tags_to_types[tag]
+        self.__invalidate()
 
-    def __call__(self):
+    def __invalidate(self):
+        '''
+        Forgets the generated classes and codecs after a field change.
+        '''
+        self.__encoder = None
+        self.__decoders.clear()
+        self.__message_class = self.__lazy_message_class = None
+
+    def message_class(self):
+        '''
+        Returns the Message subclass generated for this type, with one slot per field.
+        '''
+        if self.__message_class is None:
+            names = tuple(self.__tags_to_names.values())
+            class_name = getattr(self, 'symbol', 'cura.proto.Message').rsplit('.', 1)[-1]
+            self.__message_class = type(class_name, (Message,), {
+                '__slots__': names, 'message_type': self, '_fields': names})
+        return self.__message_class
+
+    def lazy_message_class(self):
+        '''
+        Returns the LazyMessage subclass generated for this type.
+        '''
+        if self.__lazy_message_class is None:
+            message_class = self.message_class()
+            self.__lazy_message_class = type(message_class.__name__, (LazyMessage, message_class),
+                                             {'__slots__': ('pending',)})
+        return self.__lazy_message_class
+
+    def __call__(self, **fields):
         '''
         Creates an instance of this message type.
         '''
-        return Message(self)
+        return self.message_class()(**fields)
 
     def __has_flag(self, tag, flag, mask):
         '''
@@ -371,111 +867,314 @@ class MessageType(Type):
         '''
         return (self.__flags[tag] & mask) == flag
 
-    def dump(self, fp, value):
-        if self != value.message_type:
-            raise TypeError('Attempting to dump an object with type that\'s different from mine.')
+    def __compile_encoder(self):
+        '''
+        Returns the functions sizing and emitting a message of this type for
+        a ChunkWriter, with the keys pre-encoded and the field encoding chosen
+        for every field.
+        '''
+        fields = []  # (name, sizer, emitter) in dump order.
+        required_fields = []  # (name, tag).
         for tag, field_type in self.__tags_to_types.items():
-            if self.__tags_to_names[tag] in value:
-                if self.__has_flag(tag, Flags.SINGLE, Flags.REPEATED_MASK):
-                    # Single value.
-                    UVarint.dump(fp, _pack_key(tag, field_type.WIRE_TYPE))
-                    field_type.dump(fp, value[self.__tags_to_names[tag]])
-                elif self.__has_flag(tag, Flags.PACKED_REPEATED, Flags.REPEATED_MASK):
-                    # Repeated packed value.
-                    UVarint.dump(fp, _pack_key(tag, Bytes.WIRE_TYPE))
-                    internal_fp = BytesIO()
-                    for single_value in value[self.__tags_to_names[tag]]:
-                        field_type.dump(internal_fp, single_value)
-                    Bytes.dump(fp, internal_fp.getvalue())
-                elif self.__has_flag(tag, Flags.REPEATED, Flags.REPEATED_MASK):
-                    # Repeated value.
-                    key = _pack_key(tag, field_type.WIRE_TYPE)
-                    # Put it together sequently.
-                    for single_value in value[self.__tags_to_names[tag]]:
-                        UVarint.dump(fp, key)
-                        field_type.dump(fp, single_value)
-            elif self.__has_flag(tag, Flags.REQUIRED, Flags.REQUIRED_MASK):
-                raise ValueError('The field with the tag %s is required but a value is missing.' % tag)
+            name = self.__tags_to_names[tag]
+            if self.__has_flag(tag, Flags.SINGLE, Flags.REPEATED_MASK):
+                sizer, emitter = _single_field(encode_uvarint(_pack_key(tag, field_type.WIRE_TYPE)), field_type)
+            elif self.__has_flag(tag, Flags.PACKED_REPEATED, Flags.REPEATED_MASK):
+                array_format = _array_format(field_type)
+                payload = _packed_payload(field_type) if array_format is None else \
+                    _packed_array_payload(field_type, *array_format)
+                sizer, emitter = _packed_field(encode_uvarint(_pack_key(tag, Bytes.WIRE_TYPE)), payload)
+            else:
+                sizer, emitter = _repeated_field(encode_uvarint(_pack_key(tag, field_type.WIRE_TYPE)), field_type)
+            fields.append((name, sizer, emitter))
+            if self.__has_flag(tag, Flags.REQUIRED, Flags.REQUIRED_MASK):
+                required_fields.append((name, tag))
+
+        def size(value, writer):
+            if self != value.message_type:
+                raise TypeError('Attempting to dump an object with type that\'s different from mine.')
+            for name, tag in required_fields:
+                if name not in value:
+                    raise ValueError('The field with the tag %s is required but a value is missing.' % tag)
+            total = 0
+            for name, sizer, _ in fields:
+                field_value = getattr(value, name, _absent)
+                if field_value is not _absent:
+                    total += sizer(field_value, writer)
+            return total
+
+        def emit(value, writer):
+            for name, _, emitter in fields:
+                field_value = getattr(value, name, _absent)
+                if field_value is not _absent:
+                    emitter(field_value, writer)
+
+        return size, emit
+
+    def __field_mask(self, fields):
+        '''
+        Returns a dict mapping the requested field names to the frozenset of
+        the requested fields of an embedded message, or None for all of them.
+        '''
+        names = {name: tag for tag, name in self.__tags_to_names.items()}
+        mask = dict()
+        for field in fields:
+            name, _, embedded_field = field.partition('.')
+            if name not in names:
+                raise ValueError('Unknown field \'%s\'.' % name)
+            if not embedded_field:
+                mask[name] = None
+            elif not isinstance(self.__tags_to_types[names[name]], EmbeddedMessage):
+                raise ValueError('The field \'%s\' is not an embedded message.' % name)
+            elif mask.get(name, ()) is not None:
+                mask[name] = mask.get(name, frozenset()) | {embedded_field}
+        return mask
+
+    def __decoding(self, fields=None):
+        '''
+        Returns the compiled decoding for a field mask, an iterable of field
+        names where 'a.b' selects the field b of the embedded message a.
+        '''
+        key = None if fields is None else frozenset(fields)
+        decoding = self.__decoders.get(key)
+        if decoding is None:
+            decoding = self.__decoders[key] = self.__compile_decoder(None if key is None else self.__field_mask(key))
+        return decoding
 
-    def load(self, fp):
-        fp, message = EofWrapper(fp), self.__call__()  # Wrap fp and create a new instance.
-        while True:
-            try:
-                tag, wire_type = _unpack_key(UVarint.load(fp))
-                if tag in self.__tags_to_types:
-                    field_type = self.__tags_to_types[tag]
-                    if not self.__has_flag(tag, Flags.PACKED_REPEATED, Flags.REPEATED_MASK):
-                        if wire_type != field_type.WIRE_TYPE:
-                            raise TypeError(
-                                'The received value with the tag %s has incorrect wiretype: %s instead of %s expected.' % \
-                                (tag, wire_type, field_type.WIRE_TYPE))
-                    elif wire_type != Bytes.WIRE_TYPE:
-                        raise TypeError('Tag %s has wiretype %s while the field is packed repeated.' % (tag, wire_type))
-                    if self.__has_flag(tag, Flags.SINGLE, Flags.REPEATED_MASK):
-                        # Single value.
-                        message[self.__tags_to_names[tag]] = field_type.load(fp)
-                    elif self.__has_flag(tag, Flags.PACKED_REPEATED, Flags.REPEATED_MASK):
-                        # Repeated packed value.
-                        repeated_value = message[self.__tags_to_names[tag]] = list()
-                        internal_fp = EofWrapper(fp, UVarint.load(fp))  # Limit with value length.
-                        while True:
-                            try:
-                                repeated_value.append(field_type.load(internal_fp))
-                            except EOFError:
-                                break
-                    elif self.__has_flag(tag, Flags.REPEATED, Flags.REPEATED_MASK):
-                        # Repeated value.
-                        if not self.__tags_to_names[tag] in message:
-                            repeated_value = message[self.__tags_to_names[tag]] = list()
-                        repeated_value.append(field_type.load(fp))
+    def __compile_decoder(self, mask):
+        '''
+        Returns (a function decoding a message of this type from a memoryview,
+        the readers, the absent field values), with a reader and the expected
+        wire type resolved for every tag. With a mask, the other fields are
+        skipped by length without being decoded.
+        '''
+        readers = dict()  # Maps a tag to (expected wire type, reader, packed).
+        missing = []  # (tag, name, factory of the value used when the field is absent, required).
+        ignored = set()  # The tags of the fields out of the mask.
+        for tag, field_type in self.__tags_to_types.items():
+            name = self.__tags_to_names[tag]
+            if mask is not None and name not in mask:
+                ignored.add(tag)
+                continue
+            if mask is not None and mask[name] is not None:
+                field_type = EmbeddedMessage(field_type.message_type, mask[name])
+            if self.__has_flag(tag, Flags.SINGLE, Flags.REPEATED_MASK):
+                readers[tag] = (field_type.WIRE_TYPE, _single_reader(name, field_type), False)
+            elif self.__has_flag(tag, Flags.PACKED_REPEATED, Flags.REPEATED_MASK):
+                array_format = _array_format(field_type)
+                if array_format is None:
+                    reader = _packed_reader(name, field_type)
                 else:
-                    print('TAG NOT FOUND %s %s' % (tag, wire_type))
-                    # Skip this field.
-                    _wire_type_to_type_instance[wire_type].load(fp)
-            except EOFError:
-                # Check if all required fields are present.
-                for tag, name in self.__tags_to_names.items():
-                    if name not in message:
-                        if self.__has_flag(tag, Flags.REQUIRED, Flags.REQUIRED_MASK):
-                            raise ValueError(
-                                    'The field with the tag %s (\'%s\') is required but a value is missing.' % (tag, name))
-                        field_type = self.__tags_to_types[tag]
-                        if self.__has_flag(tag, Flags.REPEATED, Flags.REPEATED_MASK):
-                            message[name] = list()  # Empty list (no values was in input stream). But required field.
-                        elif not self.__has_flag(tag, Flags.EMBEDDED, Flags.EMBEDDED_MASK):
-                            message[name] = field_type.default()
-                return message
+                    reader = _packed_array_reader(name, field_type, *array_format)
+                readers[tag] = (Bytes.WIRE_TYPE, reader, True)
+            else:
+                readers[tag] = (field_type.WIRE_TYPE, _repeated_reader(name, field_type), False)
+            if self.__has_flag(tag, Flags.REPEATED, Flags.REPEATED_MASK):
+                factory = list  # Empty list (no values was in input stream). But required field.
+            elif self.__has_flag(tag, Flags.PACKED_REPEATED, Flags.REPEATED_MASK):
+                factory = list if _array_format(field_type) is None else _empty_packed_array(field_type)
+            elif not self.__has_flag(tag, Flags.EMBEDDED, Flags.EMBEDDED_MASK):
+                factory = field_type.default
+            else:
+                factory = None
+            missing.append((tag, name, factory, self.__has_flag(tag, Flags.REQUIRED, Flags.REQUIRED_MASK)))
+
+        def decode(view):
+            message, offset, end = self.__call__(), 0, len(view)
+            try:
+                while offset < end:
+                    key, offset = decode_uvarint(view, offset)
+                    tag, wire_type = _unpack_key(key)
+                    if tag in readers:
+                        reader = _check_wire_type(readers[tag], tag, wire_type)
+                        offset = reader(view, offset, message)
+                    else:
+                        if tag not in ignored:
+                            print('TAG NOT FOUND %s %s' % (tag, wire_type))
+                        # Skip this field.
+                        offset = _skip_value(view, offset, wire_type)
+            except (IndexError, struct.error):
+                pass  # Truncated input, keep what was read like a stream hitting its end.
+            # Check if all required fields are present.
+            for tag, name, factory, required in missing:
+                if not hasattr(message, name):
+                    if required:
+                        raise ValueError(
+                            'The field with the tag %s (\'%s\') is required but a value is missing.' % (tag, name))
+                    if factory is not None:
+                        setattr(message, name, factory())
+            return message
+
+        return decode, readers, missing
+
+    def encoded_size(self, value, writer):
+        if self.__encoder is None:
+            self.__encoder = self.__compile_encoder()
+        return self.__encoder[0](value, writer)
+
+    def encode(self, value, writer):
+        self.__encoder[1](value, writer)
+
+    def dump_chunks(self, value):
+        '''
+        Dumps a message into a list of bytes-like chunks, large bytes fields
+        are referenced rather than copied.
+        '''
+        writer = ChunkWriter()
+        self.encoded_size(value, writer)
+        writer.start_encoding()
+        self.encode(value, writer)
+        return writer.chunks()
 
+    def dump(self, fp, value):
+        for chunk in self.dump_chunks(value):
+            fp.write(chunk)
+
+    def dumps(self, value):
+        return b''.join(self.dump_chunks(value))
+
+    def load(self, fp):
+        return self.loads(fp.read())
+
+    def loads(self, s, fields=None):
+        '''
+        Loads a message from a bytes-like object. When fields is given, only
+        these fields are decoded, see decode().
+        '''
+        return self.decode(memoryview(s).cast('B'), 0, fields)[0]
 
-class Message(dict):
+    def decode(self, view, offset, fields=None):
+        '''
+        Decodes a message spanning view from offset to its end. Bytes fields of
+        the result are memoryview slices of view, nothing is copied.
+
+        fields is an optional iterable of the names of the fields to decode,
+        'a.b' selecting the field b of the embedded message a. The other fields
+        are skipped by length and missing from the result.
+        '''
+        return self.__decoding(fields)[0](view[offset:] if offset else view), len(view)
+
+    def lazy_loads(self, s, fields=None):
+        '''
+        Scans a message from a bytes-like object, only recording where each
+        field is. The fields are decoded on their first access. fields
+        restricts the decoded fields like in decode().
+        '''
+        _, readers, absent = self.__decoding(fields)
+        view = memoryview(s).cast('B')
+        offsets, offset, end = dict(), 0, len(view)  # Maps a tag to the offsets of its values.
+        try:
+            while offset < end:
+                key, offset = decode_uvarint(view, offset)
+                tag, wire_type = _unpack_key(key)
+                if tag in readers:
+                    _check_wire_type(readers[tag], tag, wire_type)
+                    offsets.setdefault(tag, []).append(offset)
+                offset = _skip_value(view, offset, wire_type)
+        except (IndexError, struct.error):
+            pass  # Truncated input, keep what was scanned.
+        pending = dict()
+        for tag, name, factory, required in absent:
+            if tag in offsets:
+                pending[name] = _deferred_field(self, name, readers[tag][1], view, offsets[tag])
+            elif required:
+                raise ValueError('The field with the tag %s (\'%s\') is required but a value is missing.' % (tag, name))
+            elif factory is not None:
+                pending[name] = factory
+        return self.lazy_message_class()(pending)
+
+
+class Message:
     '''
-    Represents a message instance.
+    Represents a message instance. MessageType generates a subclass per message
+    type, with a slot per field. Fields are attributes and can also be accessed
+    like the keys of a dict, a field without value is missing.
     '''
 
-    def __init__(self, message_type):
+    __slots__ = ()
+    message_type = None  # The generated subclasses set these two.
+    _fields = ()
+
+    def __init__(self, **fields):
         '''
-        Initializes a new instance of the specified message type.
+        Initializes a new instance with the given field values.
         '''
-        self.__dict__['message_type'] = message_type
+        for name, value in fields.items():
+            setattr(self, name, value)
 
-    def __getattr__(self, name):
+    def __getitem__(self, name):
         '''
         Gets a value of the specified message field.
         '''
-        return self.__getitem__(name)
-
-    def __setattr__(self, name, value):
+        if name not in self._fields:
+            raise KeyError(name)
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __setitem__(self, name, value):
         '''
         Sets a value of the specified message field.
         '''
-        (self.__dict__ if name in self.__dict__ else self).__setitem__(name, value)
-        return value
+        if name not in self._fields:
+            raise KeyError(name)
+        setattr(self, name, value)
 
-    def __delattr__(self, name):
+    def __delitem__(self, name):
         '''
         Removes a value of the specified message field.
         '''
-        (self.__dict__ if name in self.__dict__ else self).__delitem__(name, value)
+        if name not in self._fields:
+            raise KeyError(name)
+        try:
+            delattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __contains__(self, name):
+        '''
+        Checks whether the specified message field has a value.
+        '''
+        if name not in self._fields:
+            return False
+        try:
+            object.__getattribute__(self, name)  # Bypasses __getattr__ of the subclasses.
+            return True
+        except AttributeError:
+            return False
+
+    def __iter__(self):
+        return (name for name in self._fields if Message.__contains__(self, name))
+
+    def __len__(self):
+        return sum(1 for _ in self.keys())
+
+    def keys(self):
+        return list(iter(self))
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def update(self, fields):
+        for name, value in dict(fields).items():
+            self[name] = value
+
+    def __eq__(self, other):
+        if not hasattr(other, 'items'):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % item for item in self.items()))
 
     def dumps(self):
         '''
@@ -490,6 +1189,46 @@ class Message(dict):
         return self.message_type.dump(fp, self)
 
 
+class LazyMessage(Message):
+    '''
+    Represents a message instance whose fields are decoded on first access.
+    '''
+
+    __slots__ = ()
+
+    def __init__(self, pending):
+        '''
+        Initializes a new instance, pending maps a field name to a function
+        returning its value.
+        '''
+        self.pending = pending
+
+    def __getattr__(self, name):
+        '''
+        Decodes a field on its first access.
+        '''
+        pending = object.__getattribute__(self, 'pending')
+        if name not in pending:
+            raise AttributeError(name)
+        value = pending.pop(name)()
+        setattr(self, name, value)
+        return value
+
+    def __contains__(self, name):
+        return Message.__contains__(self, name) or name in self.pending
+
+    def __iter__(self):
+        return (name for name in self._fields if name in self)
+
+    def decode_all(self):
+        '''
+        Decodes all the pending fields and returns self.
+        '''
+        for name in list(self.pending):
+            getattr(self, name)
+        return self
+
+
 def loads(self, s, message_type):
     '''
     Loads a message of the specified message type from the string.
@@ -513,11 +1252,13 @@ class EmbeddedMessage(Type):
 
     WIRE_TYPE = 2
 
-    def __init__(self, message_type):
+    def __init__(self, message_type, fields=None):
         '''
-        Initializes a new instance. The argument is an underlying message type.
+        Initializes a new instance. The argument is an underlying message type,
+        fields restricts the decoded fields like in MessageType.decode().
         '''
         self.message_type = message_type
+        self.fields = fields
 
     def __call__(self):
         '''
@@ -528,8 +1269,24 @@ class EmbeddedMessage(Type):
     def dump(self, fp, value):
         Bytes.dump(fp, self.message_type.dumps(value))
 
+    def encoded_size(self, value, writer):
+        index = len(writer.plan)
+        writer.plan.append(None)  # Reserve the place of the size, the embedded fields plan their values next.
+        size = writer.plan[index] = self.message_type.encoded_size(value, writer)
+        return uvarint_size(size) + size
+
+    def encode(self, value, writer):
+        writer.write_uvarint(writer.next_planned())
+        self.message_type.encode(value, writer)
+
     def load(self, fp):
-        return self.message_type.load(EofWrapper(fp, UVarint.load(fp)))  # Limit with embedded message length.
+        length = read_uvarint(fp)
+        return self.message_type.loads(fp.read(length) if length else b'')
+
+    def decode(self, view, offset):
+        length, offset = decode_uvarint(view, offset)
+        end = offset + length
+        return self.message_type.decode(view[offset:end], 0, self.fields)[0], end  # Limit with embedded message length.
 
 
 # Describing messages themselves. ----------------------------------------------
@@ -562,7 +1319,7 @@ class TypeMetadataType(Type):
             field_meta.type = type_str = field_type.__class__.__name__
             if isinstance(field_type, EmbeddedMessage):
                 field_meta.flags |= Flags.EMBEDDED
-                field_meta.embedded_metadata = self.__create_message(field_type.message_type)
+                field_meta.embedded = self.__create_message(field_type.message_type)
             elif not type_str.endswith('Type'):
                 raise TypeError(
                     'Type name of type singleton object should end with \'Type\'. Actual: \'%s\'.' % type_str)
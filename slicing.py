@@ -0,0 +1,190 @@
+import queue
+import threading
+from collections import defaultdict
+from time import perf_counter
+
+from .layerstore import LayerStore
+
+_END = object()
+
+
+class MessagePipeline:
+    # Calls handler(payload, type_def) from a consumer thread for the frames put() by the thread reading the engine
+    # socket, so that decoding never holds the reading. The queue between both is bounded: when the consumer falls
+    # behind, put() waits and the engine is held by the socket buffer instead of the memory growing.
+    # An exception raised by the handler is raised by the next put() and when leaving the `with` block.
+
+    def __init__(self, handler, max_depth=32):
+        self.handler = handler
+        self.error = None
+        self.put_count = 0
+        self.max_depth = 0
+        self.total_depth = 0
+        self.blocked_count = 0
+        self.blocked_seconds = 0.0
+        self._queue = queue.Queue(max_depth)
+        self._thread = threading.Thread(target=self._consume, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._queue.put(_END)
+        self._thread.join()
+        if exc_type is None and self.error is not None:
+            raise self.error
+
+    def put(self, payload, type_def):
+        if self.error is not None:
+            raise self.error
+        depth = self._queue.qsize()
+        self.put_count += 1
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+        try:
+            self._queue.put_nowait((payload, type_def))
+        except queue.Full:
+            start = perf_counter()
+            self._queue.put((payload, type_def))
+            self.blocked_count += 1
+            self.blocked_seconds += perf_counter() - start
+
+    def _consume(self):
+        while True:
+            item = self._queue.get()
+            if item is _END:
+                return
+            if self.error is None:
+                try:
+                    self.handler(*item)
+                except BaseException as error:
+                    self.error = error  # the next items are dropped so that put() never waits on a dead consumer
+
+    def metrics(self):
+        return {'messages': self.put_count, 'max_depth': self.max_depth,
+                'mean_depth': self.total_depth / self.put_count if self.put_count else 0.0,
+                'blocked_puts': self.blocked_count, 'blocked_seconds': self.blocked_seconds}
+
+
+class StallWatchdog:
+    # Calls on_stall(reason) from its own thread when the engine session stops making progress: nothing but
+    # keep-alives received for frame_timeout seconds, or a Progress amount that didn't increase for progress_timeout
+    # seconds. The reader calls frame() for every frame (type_def None for a keep-alive), the consumer progress().
+
+    def __init__(self, on_stall, frame_timeout=120.0, progress_timeout=600.0, interval=1.0):
+        self.on_stall = on_stall
+        self.frame_timeout = frame_timeout
+        self.progress_timeout = progress_timeout
+        self.interval = interval
+        self.frames = 0
+        self.keep_alives = 0
+        self.amount = None
+        self.stalled = None  # the reason of the stall
+        self.longest_frame_gap = 0.0
+        self.longest_progress_gap = 0.0
+        self._last_frame = self._last_progress = perf_counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+
+    def __enter__(self):
+        self._last_frame = self._last_progress = perf_counter()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped.set()
+        self._thread.join()
+
+    def frame(self, type_def):
+        if type_def is None:
+            self.keep_alives += 1
+            return
+        now = perf_counter()
+        self.frames += 1
+        self.longest_frame_gap = max(self.longest_frame_gap, now - self._last_frame)
+        self._last_frame = now
+
+    def progress(self, amount):
+        if self.amount is None or amount > self.amount:
+            now = perf_counter()
+            self.longest_progress_gap = max(self.longest_progress_gap, now - self._last_progress)
+            self._last_progress = now
+            self.amount = amount
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            now = perf_counter()
+            if now - self._last_frame > self.frame_timeout:
+                self.stalled = 'no message for %.1f s' % (now - self._last_frame)
+            elif now - self._last_progress > self.progress_timeout:
+                self.stalled = 'progress stuck at %s for %.1f s' % (self.amount, now - self._last_progress)
+            if self.stalled:
+                self.on_stall(self.stalled)
+                return
+
+    def stats(self):
+        now = perf_counter()
+        return {'frames': self.frames, 'keep_alives': self.keep_alives, 'amount': self.amount,
+                'longest_frame_gap': max(self.longest_frame_gap, now - self._last_frame),
+                'longest_progress_gap': max(self.longest_progress_gap, now - self._last_progress),
+                'stalled': self.stalled}
+
+
+class SliceResult:
+    # What a slice job produced, written by the engine threads and read by the UI thread.
+
+    def __init__(self, handler=None, mesh=(), spill=None):
+        # spill is the LayerSpill of the layers, see layerstore.make_layer_spill()
+        self.handler = handler
+        self.mesh = mesh
+        self.precomputed_layers = defaultdict(dict)  # only used by the UI thread
+        self.estimates = {}
+        self.gcode_file = None
+        self.exception = None
+        self.done = False
+        self.canceled = False
+        self.stalled = None  # the reason when the watchdog aborted the session
+        self.stall_retries = 0  # how many more times a stalled session is restarted
+        self.engine = None  # has terminate() and log, see curaengine.EngineHandle
+        self.layers = LayerStore(spill)
+        self._lock = threading.Lock()
+
+    def started(self, engine):
+        with self._lock:
+            self.engine = engine
+            canceled = self.canceled
+        if canceled:
+            engine.terminate()
+
+    def finish(self):
+        with self._lock:
+            self.done = True
+
+    def fail(self, exception):
+        # records the formatted exception, returns False when an earlier one was already recorded
+        with self._lock:
+            if self.exception is not None:
+                return False
+            self.exception = exception
+            return True
+
+    def close(self):
+        # releases the shared memory of the layers decoded by worker processes and the spilled layers
+        self.layers.close()
+
+    def stall(self, reason):
+        # aborts the engine that stopped making progress
+        with self._lock:
+            self.stalled = reason
+            engine = self.engine
+        if engine:
+            engine.terminate()
+
+    def cancel(self):
+        # terminates the engine, unless it's done with this job
+        with self._lock:
+            self.canceled = True
+            engine = None if self.done else self.engine
+        if engine:
+            engine.terminate()
@@ -0,0 +1,329 @@
+from array import array
+from itertools import accumulate, chain, compress, repeat
+from operator import add, mul, ne
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BUFFER_FORMATS = ('f', 'I', 'B', 'B')  # of the buffers() of a ToolpathLayer
+LOD_TOLERANCES = (0, 0.002, 0.01, 0.05)  # in cm, the largest deviation from the toolpath of each level of detail
+
+
+def _centimetres(points):
+    # the float32 values in mm of a bytes-like object as an array('f') in cm, array() copies a list faster than a map()
+    return array('f', [value / 10.0 for value in memoryview(points).cast('B').cast('f')])
+
+
+def segment_points(segment, height):
+    # The points of a PathSegment as N×3 float32 coordinates in cm, height is the layer height used for 2D points.
+    # With numpy it's an (N, 3) array, without it a flat array('f'). The values are the ones of
+    # curaengine.parse_segment() divided by 10, a float32 division rounds like the double one rounded to float32.
+    dimensions = 2 if segment.point_type == 0 else 3
+    points = memoryview(segment.points).cast('B')
+    count = len(points) // (4 * dimensions)
+    if len(points) != count * 4 * dimensions:
+        points = points[:count * 4 * dimensions]
+    if numpy is not None:
+        coords = numpy.empty((count, 3), numpy.float32)
+        coords[:, :dimensions] = numpy.frombuffer(points, numpy.float32).reshape(count, dimensions) / 10.0
+        if dimensions == 2:
+            coords[:, 2] = height / 1000 / 10
+        return coords
+    floats = _centimetres(points)
+    if dimensions == 3:
+        return floats
+    coords = array('f', [height / 1000 / 10]) * (count * 3)
+    coords[0::3] = floats[0::2]
+    coords[1::3] = floats[1::2]
+    return coords
+
+
+def line_type_strips(line_type, count, boundaries=()):
+    # Splits the first count points of a line_type byte array in strips of the same line type. A strip ends on the
+    # first point of the next one, so that the polylines are joined, except at the boundaries, the offsets where a
+    # new path segment starts. Returns {type: (offsets, lengths)} in points, the types in the order they appear, the
+    # strips in the order of the points.
+    count = min(count, len(line_type))
+    if count == 0:
+        return {}
+    if numpy is not None:
+        types = numpy.frombuffer(line_type, numpy.uint8, count)
+        breaks = numpy.zeros(count + 1, bool)
+        boundaries = numpy.asarray(boundaries, numpy.intp)
+        breaks[boundaries[boundaries < count]] = True
+        breaks[count] = True
+        changes = breaks[:count].copy()
+        changes[0] = True
+        changes[1:] |= types[1:] != types[:-1]
+        starts = numpy.flatnonzero(changes)
+        next_starts = numpy.append(starts[1:], count)
+        lengths = next_starts - starts + ~breaks[next_starts]
+        run_types = types[starts]
+        unique_types, first_runs = numpy.unique(run_types, return_index=True)
+        strips = {}
+        for type in unique_types[numpy.argsort(first_runs)]:
+            runs = run_types == type
+            strips[int(type)] = (starts[runs], lengths[runs])
+        return strips
+    types = memoryview(line_type).cast('B')[:count]
+    breaks = {boundary for boundary in boundaries if boundary < count}
+    starts = sorted(breaks.union(compress(range(1, count), map(ne, types[1:], types[:-1])), [0]))
+    breaks.add(count)
+    strips = {}
+    for start, next_start in zip(starts, starts[1:] + [count]):
+        offsets, lengths = strips.setdefault(types[start], ([], []))
+        offsets.append(start)
+        lengths.append(next_start - start + (next_start not in breaks))
+    return strips
+
+
+def strip_points(coords, offsets, lengths):
+    # the points of the strips, concatenated, in the format of segment_points()
+    if numpy is not None:
+        shift = offsets - (numpy.cumsum(lengths) - lengths)
+        return coords[numpy.arange(int(lengths.sum())) + numpy.repeat(shift, lengths)]
+    view = memoryview(coords).cast('B')
+    points = array('f')
+    points.frombytes(b''.join(map(view.__getitem__, map(slice, map(mul, offsets, repeat(12)),
+                                                        map(mul, map(add, offsets, lengths), repeat(12))))))
+    return points
+
+
+class ToolpathLayer:
+    # The toolpath of a layer in contiguous buffers, its strips grouped by line type:
+    # coords, float32 x, y, z in cm of the points of the strips, one after the other
+    # offsets, uint32 index in the points of the start of each strip, followed by the number of points
+    # types, uint8 line type of each strip
+    # extruders, uint8 extruder of each strip
+    # The buffers are kept as memoryviews, of arrays, numpy arrays or a shared memory block.
+
+    def __init__(self, layer_id, height, thickness, coords, offsets, types, extruders):
+        self.id = layer_id
+        self.height = height
+        self.thickness = thickness
+        self.coords = memoryview(coords)
+        self.offsets = memoryview(offsets)
+        self.types = memoryview(types)
+        self.extruders = memoryview(extruders)
+        self.ranges = {}  # {type: (first strip, end strip)}
+        self.lods = {}  # {(level, type): (coords, offsets)} of the simplified strips, see lod()
+        types = self.types.tobytes()
+        for type in dict.fromkeys(types):
+            self.ranges[type] = (types.index(type), types.rindex(type) + 1)
+
+    def line_types(self):
+        return self.ranges.keys()
+
+    def point_count(self, line_types=None):
+        # the number of points of the strips with one of line_types, all of them by default
+        count = 0
+        for type, (first, end) in self.ranges.items():
+            if line_types is None or type in line_types:
+                count += self.offsets[end] - self.offsets[first]
+        return count
+
+    def segment_count(self, line_types=None, level=0):
+        # the number of lines drawn for the strips with one of line_types, all of them by default, at a level of detail
+        count = 0
+        for type, (first, end) in self.ranges.items():
+            if line_types is None or type in line_types:
+                coords, offsets = self.lod(level, type)
+                count += offsets[-1] - offsets[0] - (end - first)
+        return count
+
+    def lod(self, level, line_type):
+        # (coords, offsets) of the strips of line_type at a level of detail of LOD_TOLERANCES, the simplified strips
+        # are computed on first use and kept in lods
+        first, end = self.ranges[line_type]
+        if level == 0:
+            return self.coords, self.offsets[first:end + 1]
+        if (level, line_type) not in self.lods:
+            self.lods[level, line_type] = simplify_strips(self.coords, self.offsets[first:end + 1],
+                                                          LOD_TOLERANCES[level])
+        return self.lods[level, line_type]
+
+    def strips(self, line_types=None, level=0):
+        # (line type, extruder, coords) of the strips with one of line_types, all of them by default, coords is a flat
+        # view of x, y, z
+        for type, (first, end) in self.ranges.items():
+            if line_types is None or type in line_types:
+                coords, offsets = self.lod(level, type)
+                for index in range(end - first):
+                    yield type, self.extruders[first + index], coords[offsets[index] * 3:offsets[index + 1] * 3]
+
+    def buffers(self):
+        return self.coords, self.offsets, self.types, self.extruders
+
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers())
+
+    def release(self):
+        # drops the views, so that the memory behind them can be freed
+        for buffer in self.buffers():
+            buffer.release()
+        self.ranges = {}
+        self.lods = {}
+
+
+def toolpath_layer(layer):
+    # the ToolpathLayer of a LayerOptimized, the path segments are concatenated and split in a single pass
+    line_types = []
+    boundaries = []
+    extruders = []
+    total = 0
+    if numpy is not None:
+        coords = []
+        for segment in layer.path_segment:
+            points = segment_points(segment, layer.height)
+            count = min(len(points), len(segment.line_type))
+            coords.append(points[:count])
+            line_types.append(segment.line_type[:count])
+            boundaries.append(total)
+            extruders.append(segment.extruder)
+            total += count
+        strips = line_type_strips(b''.join(line_types), total, boundaries)
+        if not strips:
+            return ToolpathLayer(layer.id, layer.height, layer.thickness, array('f'), array('I', [0]), array('B'),
+                                 array('B'))
+        coords = numpy.concatenate(coords)
+        starts = numpy.concatenate([offsets for offsets, lengths in strips.values()])
+        lengths = numpy.concatenate([lengths for offsets, lengths in strips.values()])
+        types = numpy.repeat(numpy.fromiter(strips, numpy.uint8), [len(offsets) for offsets, _ in strips.values()])
+        segments = numpy.searchsorted(numpy.asarray(boundaries), starts, 'right') - 1
+        return ToolpathLayer(layer.id, layer.height, layer.thickness,
+                             strip_points(coords, starts, lengths).reshape(-1),
+                             numpy.concatenate(([0], numpy.cumsum(lengths))).astype(numpy.uint32), types,
+                             numpy.asarray(extruders, numpy.uint8)[segments])
+    # without numpy, the points of consecutive 3D segments are converted to cm together, the per point work is in
+    # comprehensions and map() and the per segment work is kept to a minimum
+    coords = array('f')
+    pending = []  # the float32 bytes in mm of the 3D segments since the last 2D one
+    for segment in layer.path_segment:
+        line_type = segment.line_type
+        if segment.point_type == 0:
+            points = segment_points(segment, layer.height)
+            count = min(len(points) // 3, len(line_type))
+            if pending:
+                coords.extend(_centimetres(b''.join(pending)))
+                pending = []
+            coords.extend(points if count * 3 == len(points) else points[:count * 3])
+        else:
+            points = segment.points
+            count = min(len(points) // 12, len(line_type))
+            pending.append(points if count * 12 == len(points) else memoryview(points).cast('B')[:count * 12])
+        line_types.append(line_type if count == len(line_type) else line_type[:count])
+        boundaries.append(total)
+        extruders.append(segment.extruder)
+        total += count
+    if pending:
+        coords.extend(_centimetres(b''.join(pending)))
+    strips = line_type_strips(b''.join(line_types), total, boundaries)
+    multiple_extruders = len(set(extruders)) > 1
+    if multiple_extruders:
+        point_extruders = b''.join(bytes((extruder,)) * (end - start)
+                                   for extruder, start, end in zip(extruders, boundaries, boundaries[1:] + [total]))
+    strip_coords = array('f')
+    lengths = []
+    types = array('B')
+    strip_extruders = array('B')
+    for type, (starts, type_lengths) in strips.items():
+        strip_coords.extend(strip_points(coords, starts, type_lengths))
+        lengths.extend(type_lengths)
+        types.frombytes(bytes((type,)) * len(starts))
+        if multiple_extruders:
+            strip_extruders.frombytes(bytes(map(point_extruders.__getitem__, starts)))
+        else:
+            strip_extruders.frombytes(bytes(extruders[:1]) * len(starts))
+    return ToolpathLayer(layer.id, layer.height, layer.thickness, strip_coords,
+                         array('I', accumulate(chain((0,), lengths))), types, strip_extruders)
+
+
+def simplify_strips(coords, offsets, tolerance):
+    # Douglas-Peucker simplification of strips: coords is the flat x, y, z of the points, offsets the start of each
+    # strip followed by its end. Returns the (coords, offsets) of the simplified strips, each strip keeps its first and
+    # last points and the others are at most tolerance away from it. With numpy, all the strips are split at once.
+    if numpy is not None:
+        points = numpy.frombuffer(coords, numpy.float32).reshape(-1, 3)
+        offsets = numpy.frombuffer(offsets, numpy.uint32).astype(numpy.intp)
+        keep = numpy.zeros(len(points), bool)
+        keep[offsets[:-1]] = True
+        keep[offsets[1:] - 1] = True
+        first, last = offsets[:-1], offsets[1:] - 1
+        while True:
+            split = last - first >= 2
+            first, last = first[split], last[split]
+            if not len(first):
+                break
+            counts = last - first - 1
+            starts = numpy.cumsum(counts) - counts
+            owners = numpy.repeat(numpy.arange(len(first)), counts)
+            inner = numpy.arange(int(counts.sum())) - starts[owners] + first[owners] + 1
+            distances = _segment_distances(points[inner], points[first][owners], points[last][owners])
+            farthest = numpy.maximum.reduceat(distances, starts)
+            candidates = numpy.flatnonzero(distances == farthest[owners])
+            candidates = candidates[numpy.unique(owners[candidates], return_index=True)[1]]
+            split = farthest > tolerance
+            pivots = inner[candidates][split]
+            keep[pivots] = True
+            first, last = numpy.concatenate((first[split], pivots)), numpy.concatenate((pivots, last[split]))
+        kept = numpy.flatnonzero(keep)
+        kept = kept[(kept >= offsets[0]) & (kept < offsets[-1])]
+        # as memoryviews, that yield Python floats like the buffers of the layer
+        return memoryview(points[kept].reshape(-1)), memoryview(numpy.searchsorted(kept, offsets).astype(numpy.uint32))
+    simplified = array('f')
+    simplified_offsets = array('I', [0])
+    squared_tolerance = tolerance * tolerance
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        xs, ys, zs = (coords[start * 3 + axis:end * 3:3].tolist() for axis in range(3))
+        keep = {0, end - start - 1}
+        pending = [(0, end - start - 1)]
+        while pending:
+            first, last = pending.pop()
+            x, y, z = xs[first], ys[first], zs[first]
+            dx, dy, dz = xs[last] - x, ys[last] - y, zs[last] - z
+            squared_length = dx * dx + dy * dy + dz * dz
+            farthest, pivot = -1, None
+            for index in range(first + 1, last):
+                ox, oy, oz = xs[index] - x, ys[index] - y, zs[index] - z
+                ratio = (ox * dx + oy * dy + oz * dz) / squared_length if squared_length else 0
+                ratio = 0 if ratio < 0 else 1 if ratio > 1 else ratio
+                ox, oy, oz = ox - dx * ratio, oy - dy * ratio, oz - dz * ratio
+                distance = ox * ox + oy * oy + oz * oz
+                if distance > farthest:
+                    farthest, pivot = distance, index
+            if farthest > squared_tolerance:
+                keep.add(pivot)
+                pending += [(first, pivot), (pivot, last)]
+        for index in sorted(keep):
+            simplified.extend((xs[index], ys[index], zs[index]))
+        simplified_offsets.append(simplified_offsets[-1] + len(keep))
+    return simplified, simplified_offsets
+
+
+def _segment_distances(points, starts, ends):
+    # distances of the points to the segments, all (N, 3) numpy arrays
+    points, starts, ends = (values.astype(numpy.float64) for values in (points, starts, ends))
+    directions = ends - starts
+    squared_lengths = numpy.einsum('ij,ij->i', directions, directions)
+    ratios = numpy.einsum('ij,ij->i', points - starts, directions)
+    ratios = numpy.clip(numpy.divide(ratios, squared_lengths, out=numpy.zeros_like(ratios), where=squared_lengths > 0),
+                        0, 1)
+    return numpy.linalg.norm(points - starts - directions * ratios[:, None], axis=1)
+
+
+def preview_level(layers, line_types, budget, sample_size=8):
+    # the finest level of detail drawing at most about budget lines for the strips with one of line_types of layers,
+    # the coarsest if none does, the levels above 0 are estimated on a sample of the layers
+    layers = list(layers)
+    full = sum(layer.segment_count(line_types) for layer in layers)
+    if full <= budget:
+        return 0
+    sample = layers[::max(1, len(layers) // sample_size)]
+    sample_full = sum(layer.segment_count(line_types) for layer in sample)
+    for level in range(1, len(LOD_TOLERANCES)):
+        sample_count = sum(layer.segment_count(line_types, level) for layer in sample)
+        if sample_full and full * sample_count / sample_full <= budget:
+            return level
+    return len(LOD_TOLERANCES) - 1